@@ -0,0 +1,434 @@
+import json
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from email.utils import formatdate
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlencode, urlparse
+
+
+class FakeService:
+    """
+      A local stand-in for one of the services repo-sync talks to, holding its state in memory. Runs an HTTP
+      server on localhost on its own thread, optionally delaying every response, and counts the requests made
+      to each endpoint. Subclasses implement handle(), returning (status, headers, body).
+    """
+    name = 'fake'
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.counts: Counter = Counter()
+        self.lock = threading.RLock()
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _dispatch(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length > 0 else b''
+                if service.latency > 0:
+                    time.sleep(service.latency)
+                with service.lock:
+                    service.counts[f'{self.command} {service.endpoint(url.path)}'] += 1
+                    status, headers, content = service.handle(self.command, unquote(url.path),
+                                                              parse_qs(url.query, keep_blank_values=True),
+                                                              body, self.headers)
+                if isinstance(content, (dict, list)):
+                    content = json.dumps(content).encode('utf-8')
+                    headers.setdefault('Content-Type', 'application/json')
+                elif isinstance(content, str):
+                    content = content.encode('utf-8')
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, name=self.name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def endpoint(self, path: str) -> str:
+        """
+          The path with record IDs, numbers and names replaced, so that requests are counted per endpoint.
+        """
+        return re.sub(r'/\d+(?=/|$)', '/:n', path)
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts = Counter()
+
+    def handle(self, method: str, path: str, query: Dict[str, List[str]], body: bytes, headers):
+        raise NotImplementedError
+
+
+class FakeAirtable(FakeService):
+    """
+      The Airtable list and update record API for one base, understanding the filter formulas that repo-sync
+      builds: family membership, record IDs and last modified time. More than rate + burst requests to the
+      base within a second get a 429, as from Airtable.
+    """
+    name = 'airtable'
+    PAGE_SIZE = 100
+    MAX_RECORDS_PER_REQUEST = 10
+
+    def __init__(self, base_id: str, latency: float = 0.0, rate: int = 5, burst: int = 1):
+        super().__init__(latency)
+        self.base_id = base_id
+        self.rate = rate
+        self.burst = burst
+        self.tables: Dict[str, Dict[str, dict]] = {}
+        self.modified: Dict[str, float] = {}
+        self.recent = deque()
+        self.throttled = 0
+
+    def endpoint(self, path: str) -> str:
+        return re.sub(r'/rec\w+$', '/:record', path)
+
+    def add(self, table: str, record_id: str, fields: dict):
+        self.tables.setdefault(table, {})[record_id] = {'id': record_id, 'fields': fields,
+                                                        'createdTime': '2020-01-01T00:00:00.000Z'}
+        self.modified[record_id] = time.time()
+
+    def update(self, table: str, record_id: str, fields: dict):
+        self.tables[table][record_id]['fields'].update(fields)
+        self.modified[record_id] = time.time()
+
+    def _matches(self, table: str, record: dict, formula: Optional[str]) -> bool:
+        if not formula:
+            return True
+        ids = re.findall(r"RECORD_ID\(\)='(\w+)'", formula)
+        if len(ids) > 0 and record['id'] not in ids:
+            return False
+        families = [re.sub(r'\\(.)', r'\1', name) for name in
+                    re.findall(r"FIND\(',' & \"((?:[^\"\\]|\\.)*)\" & ','", formula)]
+        if len(families) > 0:
+            names = set(self.tables['Family'][family]['fields']['Name'] for family in
+                        record['fields'].get('Family', []) if family in self.tables.get('Family', {}))
+            if len(names.intersection(families)) == 0:
+                return False
+        since = re.search(r"DATETIME_PARSE\('([^']+)'\)", formula)
+        if since is not None:
+            when = datetime.strptime(since.group(1), '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+            if self.modified[record['id']] <= when.timestamp():
+                return False
+        return True
+
+    def _throttle(self) -> bool:
+        now = time.monotonic()
+        while len(self.recent) > 0 and self.recent[0] <= now - 1:
+            self.recent.popleft()
+        if len(self.recent) >= self.rate + self.burst:
+            self.throttled += 1
+            return True
+        self.recent.append(now)
+        return False
+
+    def handle(self, method, path, query, body, headers):
+        if self._throttle():
+            return 429, {}, {'errors': {'type': 'RATE_LIMIT_REACHED',
+                                        'message': 'Rate limit exceeded. Please try again later'}}
+        parts = path.strip('/').split('/')
+        if len(parts) < 3 or parts[0] != 'v0' or parts[1] != self.base_id or parts[2] not in self.tables:
+            return 404, {}, {'error': 'NOT_FOUND'}
+        table = parts[2]
+        records = self.tables[table]
+        if method == 'GET' and len(parts) == 3:
+            formula = query.get('filterByFormula', [None])[0]
+            fields = query.get('fields[]', None)
+            matching = [record for record in records.values() if self._matches(table, record, formula)]
+            offset = int(query.get('offset', ['0'])[0])
+            page_size = int(query.get('pageSize', [str(self.PAGE_SIZE)])[0])
+            page = matching[offset:offset + page_size]
+            if fields is not None:
+                page = [dict(record, fields={key: value for key, value in record['fields'].items() if key in fields})
+                        for record in page]
+            result = {'records': page}
+            if offset + page_size < len(matching):
+                result['offset'] = str(offset + page_size)
+            return 200, {}, result
+        if method == 'PATCH':
+            data = json.loads(body)
+            if len(parts) == 4:
+                if parts[3] not in records:
+                    return 404, {}, {'error': 'NOT_FOUND'}
+                self.update(table, parts[3], data['fields'])
+                return 200, {}, records[parts[3]]
+            if len(data['records']) > self.MAX_RECORDS_PER_REQUEST:
+                return 422, {}, {'error': {'type': 'INVALID_RECORDS'}}
+            if any(record['id'] not in records for record in data['records']):
+                return 422, {}, {'error': {'type': 'ROW_DOES_NOT_EXIST'}}
+            for record in data['records']:
+                self.update(table, record['id'], record['fields'])
+            return 200, {}, {'records': [records[record['id']] for record in data['records']]}
+        return 405, {}, {'error': 'METHOD_NOT_ALLOWED'}
+
+
+class FakeGitHub(FakeService):
+    """
+      The GitHub REST endpoints for a repository's issues and labels, and an organisation's classic project
+      board, along with the GraphQL query for a project column's cards. Responses carry the X-RateLimit
+      headers, with requests refused once the hourly allowance is used up. GET responses carry an ETag, and
+      as with GitHub, a 304 Not Modified for a matching If-None-Match isn't counted against the allowance.
+    """
+    name = 'github'
+    PER_PAGE = 30
+
+    def __init__(self, org: str, repo: str, latency: float = 0.0, rate_limit: int = 5000):
+        super().__init__(latency)
+        self.org = org
+        self.repo = repo
+        self.full_name = f'{org}/{repo}'
+        self.rate_limit = rate_limit
+        self.used = 0
+        self.not_modified = 0
+        self.reset = int(time.time()) + 3600
+        self.labels: Dict[str, dict] = {}
+        self.issues: Dict[int, dict] = {}
+        self.columns: Dict[int, dict] = {}
+        self.cards: Dict[int, dict] = {}
+        self.project = {'id': 1, 'number': 1, 'node_id': 'PRJ_1', 'name': 'Transformation Pipelines',
+                        'state': 'open'}
+        self._ids = 1000
+
+    def _next_id(self) -> int:
+        self._ids += 1
+        return self._ids
+
+    def endpoint(self, path: str) -> str:
+        return super().endpoint(path).replace(self.full_name, ':repo').replace(f'/orgs/{self.org}/', '/orgs/:org/')
+
+    def _label(self, name: str) -> dict:
+        if name not in self.labels:
+            self.labels[name] = {'id': self._next_id(), 'name': name, 'color': 'ededed',
+                                 'url': f'{self.url}/repos/{self.full_name}/labels/{name}'}
+        return self.labels[name]
+
+    def add_label(self, name: str):
+        self._label(name)
+
+    def add_column(self, name: str) -> dict:
+        column_id = self._next_id()
+        self.columns[column_id] = {'id': column_id, 'node_id': f'COL_{column_id}', 'name': name,
+                                   'url': f'{self.url}/projects/columns/{column_id}',
+                                   'cards_url': f'{self.url}/projects/columns/{column_id}/cards'}
+        return self.columns[column_id]
+
+    def add_issue(self, title: str, labels: List[str], state: str = 'open') -> dict:
+        number = len(self.issues) + 1
+        self.issues[number] = {
+            'id': self._next_id(), 'node_id': f'I_{number}', 'number': number, 'title': title, 'state': state,
+            'body': '', 'labels': [self._label(label) for label in labels],
+            'url': f'{self.url}/repos/{self.full_name}/issues/{number}',
+            'html_url': f'https://github.com/{self.full_name}/issues/{number}',
+            'repository_url': f'{self.url}/repos/{self.full_name}'
+        }
+        return self.issues[number]
+
+    def add_card(self, column_id: int, issue_number: int) -> dict:
+        card_id = self._next_id()
+        self.cards[card_id] = {'id': card_id, 'column_id': column_id, 'issue': issue_number,
+                               'url': f'{self.url}/projects/columns/cards/{card_id}',
+                               'content_url': self.issues[issue_number]['url']}
+        return self.cards[card_id]
+
+    def _paginate(self, path: str, items: list, query) -> tuple:
+        per_page = int(query.get('per_page', [str(self.PER_PAGE)])[0])
+        page = int(query.get('page', ['1'])[0])
+        headers = {}
+        if page * per_page < len(items):
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query.update(page=page + 1, per_page=per_page)
+            headers['Link'] = f'<{self.url}{path}?{urlencode(next_query)}>; rel="next"'
+        return 200, headers, items[(page - 1) * per_page:page * per_page]
+
+    def _repo(self) -> dict:
+        org = {'login': self.org, 'id': 1, 'url': f'{self.url}/orgs/{self.org}', 'type': 'Organization'}
+        return {'id': 1, 'name': self.repo, 'full_name': self.full_name, 'owner': org, 'organization': org,
+                'url': f'{self.url}/repos/{self.full_name}',
+                'html_url': f'https://github.com/{self.full_name}'}
+
+    def handle(self, method, path, query, body, headers):
+        if method == 'GET':
+            # reads don't change anything, so can be answered before knowing whether they count
+            status, response_headers, content = self._route(method, path, query, body)
+            if status == 200:
+                digest = sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+                response_headers['ETag'] = f'W/"{digest}"'
+            if status == 200 and headers.get('If-None-Match', None) == response_headers['ETag']:
+                self.not_modified += 1
+                status, content = 304, b''
+            elif self.used >= self.rate_limit:
+                status, response_headers, content = 403, {}, {'message': 'API rate limit exceeded'}
+            else:
+                self.used += 1
+        elif self.used >= self.rate_limit:
+            status, response_headers, content = 403, {}, {'message': 'API rate limit exceeded'}
+        else:
+            self.used += 1
+            status, response_headers, content = self._route(method, path, query, body)
+        response_headers.update({'X-RateLimit-Limit': str(self.rate_limit),
+                                 'X-RateLimit-Remaining': str(max(self.rate_limit - self.used, 0)),
+                                 'X-RateLimit-Used': str(self.used),
+                                 'X-RateLimit-Reset': str(self.reset),
+                                 'Date': formatdate(usegmt=True)})
+        return status, response_headers, content
+
+    def _route(self, method, path, query, body):
+        repo_path = f'/repos/{self.full_name}'
+        data = json.loads(body) if len(body) > 0 else None
+        if path == repo_path and method == 'GET':
+            return 200, {}, self._repo()
+        if path == repo_path + '/labels' and method == 'GET':
+            return self._paginate(path, list(self.labels.values()), query)
+        if path == repo_path + '/issues':
+            if method == 'GET':
+                state = query.get('state', ['open'])[0]
+                issues = [issue for issue in sorted(self.issues.values(), key=lambda i: -i['number'])
+                          if state == 'all' or issue['state'] == state]
+                return self._paginate(path, issues, query)
+            if method == 'POST':
+                return 201, {}, self.add_issue(data['title'], data.get('labels', []))
+        issue_match = re.fullmatch(repo_path + r'/issues/(\d+)(/labels)?(?:/([^/]+))?', path)
+        if issue_match is not None:
+            number = int(issue_match.group(1))
+            if number not in self.issues:
+                return 404, {}, {'message': 'Not Found'}
+            issue = self.issues[number]
+            if issue_match.group(2) is None and method == 'GET':
+                return 200, {}, issue
+            if issue_match.group(2) is not None and issue_match.group(3) is None and method in ('PUT', 'POST'):
+                names = data if isinstance(data, list) else data.get('labels', [])
+                if method == 'POST':
+                    names = [label['name'] for label in issue['labels']] + \
+                            [name for name in names if name not in [label['name'] for label in issue['labels']]]
+                issue['labels'] = [self._label(name) for name in names]
+                return 200, {}, issue['labels']
+            if issue_match.group(3) is not None and method == 'DELETE':
+                name = unquote(issue_match.group(3))
+                if not any(label['name'] == name for label in issue['labels']):
+                    return 404, {}, {'message': 'Label does not exist'}
+                issue['labels'] = [label for label in issue['labels'] if label['name'] != name]
+                return 200, {}, issue['labels']
+        if path == f'/orgs/{self.org}/projects' and method == 'GET':
+            project = dict(self.project, url=f'{self.url}/projects/1',
+                           html_url=f'https://github.com/orgs/{self.org}/projects/1',
+                           columns_url=f'{self.url}/projects/1/columns')
+            return self._paginate(path, [project], query)
+        if path == '/projects/1/columns' and method == 'GET':
+            return self._paginate(path, list(self.columns.values()), query)
+        card_match = re.fullmatch(r'/projects/columns/(\d+)/cards', path)
+        if card_match is not None and method == 'POST' and int(card_match.group(1)) in self.columns:
+            issue = next(issue for issue in self.issues.values() if issue['id'] == data['content_id'])
+            return 201, {}, self.add_card(int(card_match.group(1)), issue['number'])
+        move_match = re.fullmatch(r'/projects/columns/cards/(\d+)/moves', path)
+        if move_match is not None and method == 'POST' and int(move_match.group(1)) in self.cards:
+            if 'column_id' in data:
+                self.cards[int(move_match.group(1))]['column_id'] = data['column_id']
+            return 201, {}, {}
+        if path == '/graphql' and method == 'POST':
+            return 200, {}, self._column_cards(data['variables'])
+        return 404, {}, {'message': 'Not Found'}
+
+    def _column_cards(self, variables) -> dict:
+        column = next((column for column in self.columns.values() if column['node_id'] == variables['column']),
+                      None)
+        if column is None:
+            return {'errors': [{'message': 'Could not resolve to a node with the global id'}]}
+        cards = [card for card in self.cards.values() if card['column_id'] == column['id']]
+        start = int(variables['cursor'] or 0)
+        page = cards[start:start + 100]
+        return {'data': {'node': {'cards': {
+            'pageInfo': {'hasNextPage': start + 100 < len(cards), 'endCursor': str(start + 100)},
+            'nodes': [{'content': {'number': card['issue'], 'repository': {'nameWithOwner': self.full_name}}}
+                      for card in page]
+        }}}}
+
+
+class FakeJenkins(FakeService):
+    """
+      The Jenkins job API for folders and jobs: tree queries, job existence checks, and creating, reading and
+      updating job configs.
+    """
+    name = 'jenkins'
+    FOLDER = 'com.cloudbees.hudson.plugins.folder.Folder'
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        # full name -> config XML, or None for folders
+        self.jobs: Dict[str, Optional[str]] = {}
+
+    def endpoint(self, path: str) -> str:
+        return re.sub(r'(/job/[^/]+)+', '/job/:name', path)
+
+    def add_folder(self, full_name: str):
+        self.jobs[full_name] = None
+
+    def _children(self, folder: str, depth: int) -> list:
+        children = []
+        for name in sorted(self.jobs):
+            parent, _, short_name = name.rpartition('/')
+            if parent == folder:
+                child = {'name': short_name}
+                if depth > 1 and self.jobs[name] is None:
+                    child['jobs'] = self._children(name, depth - 1)
+                children.append(child)
+        return children
+
+    def handle(self, method, path, query, body, headers):
+        segments = path.strip('/').split('/')
+        names = []
+        while len(segments) >= 2 and segments[0] == 'job':
+            names.append(segments[1])
+            segments = segments[2:]
+        name = '/'.join(names)
+        action = '/'.join(segments)
+        if name != '' and name not in self.jobs:
+            return 404, {}, 'Not Found'
+        if action == 'crumbIssuer/api/json':
+            return 404, {}, 'Not Found'
+        if action == 'api/json' and method == 'GET':
+            tree = query.get('tree', [''])[0]
+            if tree == 'name':
+                return 200, {}, {'name': names[-1] if len(names) > 0 else ''}
+            return 200, {}, {'name': names[-1] if len(names) > 0 else '',
+                             'jobs': self._children(name, max(tree.count('jobs['), 1))}
+        if action == 'createItem' and method == 'POST':
+            short_name = query['name'][0]
+            full_name = f'{name}/{short_name}' if name != '' else short_name
+            if full_name in self.jobs:
+                return 400, {}, 'A job already exists with the name'
+            if query.get('mode', [None])[0] == self.FOLDER or self.FOLDER.encode('utf-8') in body:
+                self.jobs[full_name] = None
+            else:
+                self.jobs[full_name] = body.decode('utf-8')
+            return 200, {}, ''
+        if action == 'config.xml' and self.jobs.get(name) is not None:
+            if method == 'GET':
+                return 200, {'Content-Type': 'application/xml'}, self.jobs[name]
+            if method == 'POST':
+                self.jobs[name] = body.decode('utf-8')
+                return 200, {}, ''
+        return 404, {}, 'Not Found'
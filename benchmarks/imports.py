@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+# Client libraries that only the GitHub, Jenkins, XML diff and Git backends should import
+BACKEND_MODULES = ['github', 'jenkins', 'lxml', 'xmldiff', 'git', 'progress']
+SCENARIOS = {
+    # what every run pays, before knowing which services a family uses
+    'import': 'import reposync.reposync',
+    'help': 'from reposync.reposync import sync\n'
+            'sys.argv = ["repo-sync", "--help"]\n'
+            'try:\n'
+            '    sync()\n'
+            'except SystemExit:\n'
+            '    pass',
+    # for comparison, the cost of a run that uses every backend
+    'backends': 'import reposync.reposync\n'
+                'from reposync import backends\n'
+                'for name in ["github", "jenkins", "xmldiff", "git"]:\n'
+                '    backends.load(name)'
+}
+MEASURE = """
+import json, sys, time
+started = time.perf_counter()
+{code}
+seconds = time.perf_counter() - started
+json.dump({{'seconds': seconds, 'modules': sorted(sys.modules)}}, sys.stderr)
+"""
+
+
+def measure(code: str) -> dict:
+    """
+      Run the code in a fresh interpreter, returning the time taken by the code itself and by the whole process,
+      along with the modules it imported.
+    """
+    env = dict(os.environ, PYTHONPATH=str(PACKAGE_ROOT) + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', MEASURE.format(code=code)], env=env, cwd=PACKAGE_ROOT,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True)
+    total = time.perf_counter() - started
+    result = json.loads(process.stderr.strip().splitlines()[-1])
+    result['total_seconds'] = total
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how long repo-sync takes to import, and check that the '
+                                                 'service backends are only imported when used.')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters to time each scenario in')
+    parser.add_argument('--max-seconds', type=float,
+                        help='Fail if importing repo-sync takes longer than this, taking the median of the runs')
+    parser.add_argument('--output', help='Write the results as JSON')
+    args = parser.parse_args()
+
+    print(f'{"scenario":<10} {"import":>8} {"process":>8}  backend modules loaded')
+    results = {}
+    failed = False
+    for name, code in SCENARIOS.items():
+        runs = [measure(code) for _ in range(args.runs)]
+        loaded = [module for module in BACKEND_MODULES if module in runs[0]['modules']]
+        results[name] = {'seconds': statistics.median(run['seconds'] for run in runs),
+                         'total_seconds': statistics.median(run['total_seconds'] for run in runs),
+                         'backend_modules': loaded}
+        print(f'{name:<10} {results[name]["seconds"]:>7.3f}s {results[name]["total_seconds"]:>7.3f}s  '
+              f'{", ".join(loaded) or "-"}')
+        if name != 'backends' and len(loaded) > 0:
+            print(f'  {name} should not import {", ".join(loaded)}', file=sys.stderr)
+            failed = True
+    if args.max_seconds is not None and results['import']['seconds'] > args.max_seconds:
+        print(f'  importing repo-sync took {results["import"]["seconds"]:.3f}s, more than {args.max_seconds}s',
+              file=sys.stderr)
+        failed = True
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'runs': args.runs, 'scenarios': results}, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fakes import FakeAirtable, FakeGitHub, FakeJenkins
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+AIRTABLE_BASE = 'appb66460atpZjzMq'
+FAMILY = 'Benchmark'
+GITHUB_ORG = 'bench-org'
+GITHUB_REPO = 'family-benchmark'
+JENKINS_PATH = ['GSS_data', 'Benchmark']
+TECH_STAGES = ['To Do', 'In Progress', 'Review', 'Done']
+BOARD_COLUMNS = ['To Do', 'In Progress', 'Done']
+# cold: nothing exists yet, warm: everything is up to date, changed: some tech stages have moved on
+PHASES = ['cold', 'warm', 'changed']
+CHANGED_FRACTION = 0.1
+SYNC_ARGS = ['-g', '-a', '-j', '--offline']
+
+
+def record_id(kind: str, i: int) -> str:
+    """
+      A record ID in Airtable's format, 'rec' then 14 letters and digits, e.g. recSOURCE00000042.
+    """
+    return f'rec{kind}{i:0{14 - len(kind)}d}'
+
+
+def populate(airtable: FakeAirtable, github: FakeGitHub, jenkins: FakeJenkins, size: int, rng: random.Random):
+    """
+      A synthetic family of the given number of datasets, along with as many sources belonging to another
+      family, which a sync of this family shouldn't need to download.
+    """
+    airtable.add('Family', record_id('FAMILY', 1), {'Name': FAMILY})
+    airtable.add('Family', record_id('FAMILY', 2), {'Name': 'Other'})
+    producers = [record_id('PRODUCER', i) for i in range(max(size // 10, 1))]
+    for i, producer in enumerate(producers):
+        airtable.add('Dataset Producer', producer, {'Name': f'Producer {i}', 'Full Name': f'Producer Number {i}'})
+    types = [record_id('TYPE', i) for i in range(1, 4)]
+    for i, data_type in enumerate(types):
+        airtable.add('Type', data_type, {'Name': ['Spreadsheet', 'CSV', 'API'][i]})
+    for family, kind in [(record_id('FAMILY', 1), 'SOURCE'), (record_id('FAMILY', 2), 'OTHER')]:
+        for i in range(size):
+            airtable.add('Source Data', record_id(kind, i), {
+                'Name': f'Dataset {i}',
+                'Producer': [rng.choice(producers)],
+                'Family': [family],
+                'Data type': [rng.choice(types)],
+                'Description': f'Synthetic dataset number {i}.',
+                'Landing Page': f'https://example.org/datasets/{i}',
+                'BA Stage': 'Prioritized',
+                'Tech Stage': [rng.choice(TECH_STAGES)]
+            })
+    for stage in TECH_STAGES:
+        github.add_label(stage)
+    for column in BOARD_COLUMNS:
+        github.add_column(column)
+    for i in range(len(JENKINS_PATH)):
+        jenkins.add_folder('/'.join(JENKINS_PATH[:i + 1]))
+
+
+def change_stages(airtable: FakeAirtable, rng: random.Random, fraction: float):
+    sources = [rec_id for rec_id in airtable.tables['Source Data'] if rec_id.startswith('recSOURCE')]
+    for rec_id in rng.sample(sources, max(int(len(sources) * fraction), 1)):
+        airtable.update('Source Data', rec_id, {'Tech Stage': [rng.choice(TECH_STAGES)]})
+
+
+def make_family_repo(work_dir: Path, jenkins: FakeJenkins) -> Path:
+    repo_dir = work_dir / 'repo'
+    (repo_dir / 'datasets').mkdir(parents=True)
+    subprocess.run(['git', 'init', '-q'], cwd=repo_dir, check=True)
+    with open(repo_dir / 'datasets' / 'info.json', 'w') as info_file:
+        json.dump({'family': FAMILY,
+                   'github': f'https://github.com/{GITHUB_ORG}/{GITHUB_REPO}',
+                   'jenkins': {'base': jenkins.url + '/', 'path': JENKINS_PATH}}, info_file, indent=4)
+    config_dir = work_dir / 'home' / '.config' / 'reposync'
+    config_dir.mkdir(parents=True)
+    (config_dir / 'airtable-token').write_text('bench-airtable-token\n')
+    (config_dir / 'github-token').write_text('bench-github-token\n')
+    (config_dir / 'jenkins-token').write_text(json.dumps({'username': 'bench', 'token': 'bench-jenkins-token'}))
+    return repo_dir
+
+
+def run_sync(work_dir: Path, repo_dir: Path, airtable: FakeAirtable, github: FakeGitHub, log_name: str,
+             profile_dir: Path = None, workers: int = None) -> dict:
+    """
+      Run repo-sync in a fresh interpreter, so that each run's peak memory is its own, against the fake
+      services.
+    """
+    result_file = work_dir / f'{log_name}.json'
+    env = dict(os.environ,
+               HOME=str(work_dir / 'home'),
+               PYTHONPATH=str(PACKAGE_ROOT) + os.pathsep + os.environ.get('PYTHONPATH', ''),
+               AIRTABLE_API_URL=f'{airtable.url}/v0',
+               GITHUB_API_URL=github.url,
+               GITHUB_GRAPHQL_URL=f'{github.url}/graphql')
+    env.pop('AIRTABLE_API_KEY', None)
+    with open(work_dir / f'{log_name}.log', 'w') as log:
+        command = [sys.executable, __file__, '--worker', str(result_file)]
+        if profile_dir is not None:
+            command += ['--worker-profile', str(profile_dir.resolve() / f'{log_name}.json')]
+        if workers is not None:
+            command += ['--worker-workers', str(workers)]
+        subprocess.run(command, cwd=repo_dir, env=env,
+                       stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+    with open(result_file) as f:
+        return json.load(f)
+
+
+def worker(result_file: str, profile: str = None, workers: int = None):
+    started = time.perf_counter()
+    try:
+        from reposync.reposync import sync
+        imported = time.perf_counter()
+        sys.argv = ['repo-sync'] + SYNC_ARGS + (['--profile', profile] if profile is not None else []) + \
+                   (['--workers', str(workers)] if workers is not None else [])
+        sync()
+        error = None
+    except BaseException as e:
+        imported = locals().get('imported', time.perf_counter())
+        error = f'{type(e).__name__}: {e}'
+    finished = time.perf_counter()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    peak_mb = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    with open(result_file, 'w') as f:
+        json.dump({'import_seconds': imported - started, 'sync_seconds': finished - imported,
+                   'peak_mb': peak_mb, 'error': error}, f)
+
+
+def benchmark(size: int, latency: float, seed: int, profile_dir: Path = None, workers: int = None) -> list:
+    rng = random.Random(seed)
+    airtable = FakeAirtable(AIRTABLE_BASE, latency).start()
+    github = FakeGitHub(GITHUB_ORG, GITHUB_REPO, latency).start()
+    jenkins = FakeJenkins(latency).start()
+    services = [airtable, github, jenkins]
+    populate(airtable, github, jenkins, size, rng)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix=f'reposync-bench-{size}-') as work:
+            work_dir = Path(work)
+            repo_dir = make_family_repo(work_dir, jenkins)
+            for phase in PHASES:
+                if phase == 'changed':
+                    change_stages(airtable, rng, CHANGED_FRACTION)
+                for service in services:
+                    service.reset_counts()
+                airtable.throttled = 0
+                github.not_modified = 0
+                run = run_sync(work_dir, repo_dir, airtable, github, f'{size}-{phase}', profile_dir, workers)
+                if run['error'] is not None:
+                    with open(work_dir / f'{size}-{phase}.log') as log:
+                        print(log.read()[-4000:], file=sys.stderr)
+                run.update(size=size, phase=phase,
+                           requests={service.name: dict(sorted(service.counts.items())) for service in services},
+                           airtable_throttled=airtable.throttled, github_not_modified=github.not_modified)
+                results.append(run)
+                print(format_row(run), flush=True)
+    finally:
+        for service in services:
+            service.stop()
+    return results
+
+
+def format_row(run: dict) -> str:
+    totals = ' '.join(f'{name}={sum(counts.values()):<6}' for name, counts in run['requests'].items())
+    status = '' if run['error'] is None else f'  FAILED {run["error"]}'
+    return (f'{run["size"]:>6} {run["phase"]:<8} {run["sync_seconds"]:>9.2f}s {run["import_seconds"]:>7.2f}s '
+            f'{run["peak_mb"]:>8.1f} MB  {totals}{status}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark repo-sync against local stand-ins for Airtable, GitHub '
+                                                 'and Jenkins.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Numbers of datasets in the synthetic families')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds added to every response from the fake services')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results, including request counts per endpoint, as JSON')
+    parser.add_argument('--profile-dir', type=Path,
+                        help='Also write a repo-sync --profile report for each run to this directory')
+    parser.add_argument('--workers', type=int,
+                        help="Datasets for repo-sync to work on at once, by default repo-sync's own default")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-profile', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-workers', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker is not None:
+        worker(args.worker, args.worker_profile, args.worker_workers)
+        return
+    if args.profile_dir is not None:
+        args.profile_dir.mkdir(parents=True, exist_ok=True)
+
+    print(f'{"size":>6} {"phase":<8} {"sync":>10} {"import":>8} {"peak":>11}  requests')
+    results = []
+    for size in args.sizes:
+        results.extend(benchmark(size, args.latency, args.seed, args.profile_dir, args.workers))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'latency': args.latency, 'seed': args.seed, 'runs': results}, f, indent=2)
+    if any(run['error'] is not None for run in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -41,6 +41,11 @@ try:
     prdDat = dataTables[2]
     tpeDat = dataTables[3]
     pmdDat = dataTables[4]
+
+    # Index the lookup tables once, rather than scanning them for every source record
+    famIDs = ut.getFamilyIDs(famDat, atfam)
+    prdIdx = ut.indexByRecordID(prdDat)
+    tpeIdx = ut.indexByRecordID(tpeDat)
     ret = 'success'
 
 except Exception as e:
@@ -78,7 +83,7 @@ try:
             for i in srcDat:  # CLASS LIST
                 try:
                     # If this ETL is for the Family that has been passed then process it
-                    if ut.checkFamily(i['fields']['Family'][0], famDat, atfam):
+                    if ut.checkFamily(i['fields']['Family'][0], famIDs):
                         nme1 = i['fields']['Name']
                         try:
                             #stg = i['fields']['BA Stage']
@@ -90,12 +95,12 @@ try:
                         if 1 == 1: #stg == 'Prioritized':
                             print(nme1 + ' is prioritised, initialising variables')
                             try:
-                                pdr = ut.getProducer(i['fields']['Producer'], prdDat)
+                                pdr = ut.getProducer(i['fields']['Producer'], prdIdx)
                             except Exception as e:
                                 pdr = ['N/A']
 
                             try:
-                                dtp = ut.getDataType(i['fields']['Data type'], tpeDat)
+                                dtp = ut.getDataType(i['fields']['Data type'], tpeIdx)
                             except Exception as e:
                                 dtp = ['N/A']
 
@@ -32,24 +32,29 @@ def createInfoJSONFile(pth, jsonInfo, inx, fleNme, gitNme):
         return f'{fleNme} file creation failure: ' + str(e)
 
 
-# Check if the Family is the one you want, passed param has been changed for testing purposes
-def checkFamily(transformFam, airTableFamilies, wantedFam):
+# Index AirTable records by their Record ID, so that looking one up doesn't mean scanning the whole table
+def indexByRecordID(atRecords):
+    try:
+        return {rw['fields']['Record ID']: rw for rw in atRecords if 'Record ID' in rw['fields']}
+    except Exception as e:
+        return {}
+
+
+# The Record IDs of the AirTable Families with the wanted name, worked out once for use with checkFamily
+def getFamilyIDs(airTableFamilies, wantedFam):
+    try:
+        return set(fm['fields']['Record ID'] for fm in airTableFamilies
+                   if 'Record ID' in fm['fields'] and fm['fields'].get('Name') == wantedFam)
+    except Exception as e:
+        return set()
+
+
+# Check if the Family is the one you want, given the Record IDs from getFamilyIDs
+def checkFamily(transformFam, familyIDs):
     try:
         # ASSUMES THEIR IS ONLY ONE FAMILY ASSOCIATED WITH THIS ETL
         # AND PULLS IN THE FIRST ONE FROM THE LIST (SHOULD ONLY BE ONE THING IN THE LIST)
-        # --------------------------------------------------------------------------------------
-        # --------------------------------------------------------------------------------------
-        # THIS NEEDS TO BE REMOVED ONCE WORKING PROPERLY
-        #wantedFam = 'COVID-19'
-        # --------------------------------------------------------------------------------------
-        # --------------------------------------------------------------------------------------
-        ret = False
-        for fm in airTableFamilies:
-            if fm['fields']['Record ID'] == transformFam:
-                if fm['fields']['Name'] == wantedFam:
-                    ret = True
-                    break
-        return ret
+        return transformFam in familyIDs
     except Exception as e:
         return False
 
@@ -108,29 +113,18 @@ def seeIfFolderExists(tfNme, stage, dsPth):
 #        return 'seeIfFolderExists FAILURE: ' + str(e)
 
 
-def getDataType(datTpe, tpeCde):
+# Data type names for the given Record IDs, looked up in the index from indexByRecordID
+def getDataType(datTpe, tpeIndex):
     try:
-        i = 0
-        ret = []
-        for i in datTpe:
-            for dt in tpeCde:
-                if dt['fields']['Record ID'] == i:
-                    ret.append(dt['fields']['Name'])
-                    break
-        return ret
+        return [tpeIndex[i]['fields']['Name'] for i in datTpe if i in tpeIndex]
     except Exception as e:
         return []
 
 
-def getProducer(mainPrd, prods):
+# Producer names for the given Record IDs, looked up in the index from indexByRecordID
+def getProducer(mainPrd, prdIndex):
     try:
-        ret = []
-        for mp in mainPrd:
-            for rw in prods:
-                if rw['fields']['Record ID'] == mp:
-                    ret.append(rw['fields']['Name'])
-                    break
-        return ret
+        return [prdIndex[mp]['fields']['Name'] for mp in mainPrd if mp in prdIndex]
     except Exception as e:
         return []
 
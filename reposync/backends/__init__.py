@@ -0,0 +1,10 @@
+from importlib import import_module
+from types import ModuleType
+
+
+def load(name: str) -> ModuleType:
+    """
+      A backend module, e.g. load('github'), imported on first use so that runs which don't need GitHub, Jenkins
+      or Git don't pay for importing their client libraries.
+    """
+    return import_module(f'{__name__}.{name}')
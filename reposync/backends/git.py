@@ -0,0 +1,10 @@
+from pathlib import Path
+
+from git import Repo
+
+
+def branch_ref(root: Path) -> str:
+    """
+      The branch checked out in a repository, e.g. refs/heads/master.
+    """
+    return Repo(root).head.ref.path
@@ -0,0 +1,290 @@
+import threading
+from importlib import resources
+from typing import Dict, Optional
+
+import requests
+from github import Github, GithubException, UnknownObjectException
+from github.Issue import Issue
+from github.Label import Label
+from github.Organization import Organization
+from github.Project import Project
+from github.ProjectColumn import ProjectColumn
+from github.Repository import Repository
+from progress.bar import Bar
+
+try:
+    from .. import templates
+    from ..datasets import DatasetTree
+    from ..httpcache import CachingAdapter, HTTPCache
+    from ..plan import SyncPlan
+    from ..ratelimit import Service
+except:
+    import templates
+    from datasets import DatasetTree
+    from httpcache import CachingAdapter, HTTPCache
+    from plan import SyncPlan
+    from ratelimit import Service
+
+GITHUB_BASE = 'https://github.com/'
+COLUMN_CARDS_QUERY = """
+query($column: ID!, $cursor: String) {
+  node(id: $column) {
+    ... on ProjectColumn {
+      cards(first: 100, after: $cursor, archivedStates: [NOT_ARCHIVED]) {
+        pageInfo { hasNextPage endCursor }
+        nodes { content { ... on Issue { number repository { nameWithOwner } } } }
+      }
+    }
+  }
+}
+"""
+
+
+def connect(token: Optional[str], base_url: str, pool_size: int, service: Service,
+            cache: Optional[HTTPCache] = None) -> Github:
+    """
+      A GitHub client whose requests are paced, and retried, by the service's scheduler rather than by
+      PyGithub, and revalidated against the cache if given. GitHub doesn't count a 304 Not Modified against the
+      rate limit, so issues, labels and board columns that haven't changed since the last sync come almost for
+      free.
+    """
+    g = Github(token, base_url=base_url, per_page=100, pool_size=pool_size, retry=None,
+               seconds_between_requests=None, seconds_between_writes=None)
+    try:
+        # The adapters are mounted on the requester's own persistent connection, as replacing its connection
+        # classes would turn off connection reuse.
+        connection = g._Github__requester._Requester__createConnection()
+    except AttributeError as e:
+        print(f'Warning: unable to schedule or cache GitHub requests with this version of PyGithub:\n{e}')
+        return Github(token, base_url=base_url, per_page=100, pool_size=pool_size)
+    adapter = service.adapter()
+    if cache is not None:
+        adapter = CachingAdapter(cache, adapter)
+    connection.session.mount('https://', adapter)
+    connection.session.mount('http://', adapter)
+    return g
+
+
+class IssueIndex:
+    """
+      A repository's issues, listed once and looked up by number, or by title amongst the open issues. Issues
+      missing from the listing are fetched holding the given lock, as PyGithub's connection can't be shared
+      between threads making requests at once.
+    """
+
+    def __init__(self, repo: Repository, lock: threading.RLock):
+        self.repo = repo
+        self.lock = lock
+        self.by_number: Dict[int, Issue] = {}
+        self.by_title: Dict[str, Issue] = {}
+        for issue in repo.get_issues(state='all'):
+            self.add(issue)
+
+    def add(self, issue: Issue):
+        self.by_number[issue.number] = issue
+        if issue.state == 'open':
+            # issues are listed newest first, matching a search through repo.get_issues()
+            self.by_title.setdefault(issue.title, issue)
+
+    def get(self, number: int) -> Issue:
+        with self.lock:
+            if number not in self.by_number:
+                self.add(self.repo.get_issue(number=number))
+            return self.by_number[number]
+
+    def forget(self, number: int):
+        """
+          Drop an issue that has changed, so that it is fetched again when next looked up.
+        """
+        with self.lock:
+            issue = self.by_number.pop(number, None)
+            if issue is not None and self.by_title.get(issue.title) is issue:
+                del self.by_title[issue.title]
+
+    def refresh(self, number: int) -> Issue:
+        with self.lock:
+            self.forget(number)
+            return self.get(number)
+
+    def find(self, title: str) -> Optional[Issue]:
+        return self.by_title.get(title)
+
+
+class GitHubContext:
+    """
+      The GitHub client, repository, organisation, labels, issues and project board columns used throughout a
+      sync, so that they are only looked up once, even when datasets are planned concurrently.
+    """
+
+    def __init__(self, github: Github, repo: Repository):
+        self.github = github
+        self.repo = repo
+        self.issue_column: Dict[int, ProjectColumn] = {}
+        self.todo_column: Optional[ProjectColumn] = None
+        self._labels: Optional[Dict[str, Label]] = None
+        self._issues: Optional[IssueIndex] = None
+        # held for any request made while datasets are being planned concurrently, as PyGithub's connection
+        # keeps the request it is sending on itself until the response comes back
+        self._lock = threading.RLock()
+
+    @property
+    def org(self) -> Organization:
+        return self.repo.organization
+
+    @property
+    def labels(self) -> Dict[str, Label]:
+        with self._lock:
+            if self._labels is None:
+                self._labels = {label.name: label for label in self.repo.get_labels()}
+        return self._labels
+
+    @property
+    def issues(self) -> IssueIndex:
+        with self._lock:
+            if self._issues is None:
+                self._issues = IssueIndex(self.repo, self._lock)
+        return self._issues
+
+
+def get_github_context(g: Github, repo_url) -> Optional[GitHubContext]:
+    if not repo_url.startswith(GITHUB_BASE):
+        print(f'Github repo URL not recognised {repo_url}.')
+        return None
+    try:
+        return GitHubContext(g, g.get_repo(repo_url[len(GITHUB_BASE):]))
+    except UnknownObjectException:
+        print(f'Unknown repo {repo_url[len(GITHUB_BASE):]}')
+        return None
+
+
+def get_project_board(github: GitHubContext, project_url):
+    return next((project for project in github.org.get_projects()
+                 if (project_url is not None and getattr(project, 'html_url', None) == project_url) or
+                    (project_url is None and project.name == 'Transformation Pipelines')), None)
+
+
+def get_column_issues(session: requests.Session, column: ProjectColumn, graphql_url: str):
+    """
+      Issue number and repository name of each card in a project column, fetched 100 cards at a time using the
+      GraphQL API rather than requesting the content of every card.
+    """
+    cursor = None
+    while True:
+        response = session.post(graphql_url, json={'query': COLUMN_CARDS_QUERY,
+                                                   'variables': {'column': column.node_id, 'cursor': cursor}})
+        response.raise_for_status()
+        result = response.json()
+        if 'errors' in result:
+            raise GithubException(response.status_code, result, None)
+        cards = result['data']['node']['cards']
+        for card in cards['nodes']:
+            if card['content'] is not None and 'number' in card['content']:
+                yield card['content']['number'], card['content']['repository']['nameWithOwner']
+        if not cards['pageInfo']['hasNextPage']:
+            break
+        cursor = cards['pageInfo']['endCursor']
+
+
+def get_board_issue_columns(session: requests.Session, board: Project, repo_url, graphql_url: str):
+    issue_column: Dict[int, ProjectColumn] = {}
+    todo_column: Optional[ProjectColumn] = None
+    for column in Bar('Fetching board issues').iter(list(board.get_columns())):
+        if column.name.lower() == 'to do':
+            todo_column = column
+        try:
+            for number, repo_name in get_column_issues(session, column, graphql_url):
+                if repo_url.endswith(repo_name):
+                    issue_column[number] = column
+        except (requests.exceptions.RequestException, GithubException) as e:
+            print(f'Warning: unable to query cards of column {column.name}, fetching them individually:\n{e}')
+            for issue in (card.get_content() for card in column.get_cards()):
+                if isinstance(issue, Issue) and repo_url.endswith(issue.repository.full_name):
+                    issue_column[issue.number] = column
+    return issue_column, todo_column
+
+
+def plan_github(plan: SyncPlan, dataset_dir, issue_no, title, source, github: GitHubContext, rec_id, used_labels):
+    """
+      Work out the changes needed to a dataset's GitHub issue, returning the issue's number and URL if it exists.
+    """
+    if issue_no is not None and issue_no <= 0:
+        print(f'Github issue number not valid: {issue_no}.')
+        return None, None
+    if issue_no is None:
+        # look for a match against the expected title
+        issue = github.issues.find(title)
+        if issue is None:
+            print(f"Need to create new GitHub issue for {title}")
+            stage_labels = sorted(source.get('Tech Stage', []))
+            plan.new_issue(dataset_dir, title, stage_labels, 'To Do' in stage_labels, rec_id)
+            return None, None
+    else:
+        issue = github.issues.get(issue_no)
+    issue_no = issue.number
+    airtable_labels = set(
+        [label.name for label in issue.labels if label.name in used_labels])
+    if 'Tech Stage' in source:
+        stage_labels = set(source['Tech Stage'])
+        to_remove = airtable_labels - stage_labels
+        to_add = stage_labels - airtable_labels
+        if len(to_remove) > 0:
+            print(f'Need to remove "{", ".join(to_remove)}" from issue {issue_no}')
+        if len(to_add) > 0:
+            print(f'Need to add "{", ".join(to_add)}" for issue {issue_no}')
+            missing = to_add - github.labels.keys()
+            if len(missing) > 0:
+                print(f'Label(s) "{", ".join(missing)}" not yet defined in {github.repo.full_name}, '
+                      f'GitHub will create them.')
+        plan.set_labels(dataset_dir, issue_no, sorted(to_add), sorted(to_remove))
+        if issue_no not in github.issue_column and 'To Do' in stage_labels and issue.state == 'open':
+            print(f'Issue {issue_no} is not on project board and should be in To Do column.')
+            plan.add_card(dataset_dir, issue_no, 'To Do')
+    return issue.number, issue.html_url
+
+
+def apply_github(plan: SyncPlan, github: GitHubContext, tree: DatasetTree):
+    """
+      Create the planned issues, with their labels, then add and remove the planned labels of existing issues,
+      leaving any others as they are now, whatever they were when listed, and add cards to the project board.
+      New issues' numbers are recorded in the plan's Airtable and file changes.
+    """
+    for new_issue in plan.issues:
+        issue = github.repo.create_issue(
+            new_issue['title'],
+            body=resources.read_text(templates, 'issue_body.md'),
+            labels=new_issue['labels']
+        )
+        print(f'Created issue {issue.number} for {new_issue["title"]}.')
+        github.issues.add(issue)
+        tree.info(new_issue['dataset'])['transform']['main_issue'] = issue.number
+        plan.write_file(new_issue['dataset'], str(tree.root / new_issue['dataset'] / 'info.json'))
+        for record in new_issue['records']:
+            plan.update_record(new_issue['dataset'], record, {
+                'GitHub Issue Number': issue.number,
+                'GitHub Issue URL': issue.html_url
+            })
+        if new_issue['todo']:
+            plan.add_card(new_issue['dataset'], issue.number, 'To Do')
+    for change in plan.labels:
+        issue = github.issues.get(change['issue'])
+        for label in change['remove']:
+            try:
+                issue.remove_from_labels(label)
+                print(f'Removed "{label}".')
+            except UnknownObjectException:
+                # someone got there first
+                pass
+        if len(change['add']) > 0:
+            issue.add_to_labels(*change['add'])
+            for label in change['add']:
+                print(f'Added "{label}".')
+        github.issues.forget(issue.number)
+    for card in plan.cards:
+        if github.todo_column is None:
+            print(f'No To Do column on the project board for issue {card["issue"]}.')
+            continue
+        issue = github.issues.get(card['issue'])
+        created = github.todo_column.create_card(content_id=issue.id, content_type='Issue')
+        created.move('top', github.todo_column)
+        github.issue_column[issue.number] = github.todo_column
+
@@ -0,0 +1,251 @@
+import json
+import os
+from hashlib import sha256
+from importlib import resources
+from json import JSONDecodeError
+from pathlib import Path
+from string import Template
+from typing import Dict, List, Set, Union
+
+from jenkins import Jenkins, JenkinsException
+from lxml.etree import canonicalize, fromstring
+
+try:
+    from . import load
+    from .. import templates
+    from ..datasets import pathify
+    from ..engine import map_ordered
+    from ..plan import SyncPlan
+    from ..ratelimit import Service
+except:
+    from backends import load
+    import templates
+    from datasets import pathify
+    from engine import map_ordered
+    from plan import SyncPlan
+    from ratelimit import Service
+
+
+def connect(base: str, username: str, password: str, service: Service) -> Jenkins:
+    """
+      A Jenkins client whose requests go through the service's scheduler, which retries them after transient
+      errors, with the service's timeouts.
+    """
+    server = Jenkins(base, username=username, password=password, timeout=service.timeout)
+    session = getattr(server, '_session', None)
+    if session is not None:
+        session.mount(base, service.adapter())
+    return server
+
+
+def canonicalize_jenkins_xml(xml: Union[str, bytes]) -> str:
+    def _extract_plugin_name(plugin_name_and_maybe_version: str) -> str:
+        parts = plugin_name_and_maybe_version.split('@')
+
+        if len(parts) == 1:
+            return parts[0]
+        elif len(parts) > 1:
+            return parts[:-1]
+        else:
+            raise Exception(f'Invalid plugin name found: {plugin_name_and_maybe_version}')
+
+    root = fromstring(xml.encode('utf-8') if isinstance(xml, str) else xml)
+    for node_with_plugin in root.xpath('//node()[@plugin]'):
+        plugin_without_version = ''.join(_extract_plugin_name(node_with_plugin.get('plugin')))
+        node_with_plugin.set('plugin', plugin_without_version)
+    return canonicalize(root)
+
+
+class JenkinsJobIndex:
+    """
+      Full names of the jobs and folders under a Jenkins folder, read with a single tree query rather than
+      checking each job in turn.
+    """
+
+    def __init__(self, server: Jenkins, path: List[str], depth: int = 3):
+        self.server = server
+        self.root = '/'.join(path)
+        self.names: Set[str] = set()
+        tree = 'jobs[name]'
+        for _ in range(depth - 1):
+            tree = f'jobs[name,{tree}]'
+        try:
+            info = server.get_info(item='job/' + '/job/'.join(path), query=f'?tree={tree}')
+        except JenkinsException as e:
+            print(f'Jenkins folder at {self.root} not found:\n{e}')
+            return
+        self.names.add(self.root)
+        self._add_jobs(self.root, info)
+
+    def _add_jobs(self, folder: str, info: dict):
+        for job in info.get('jobs', None) or []:
+            self.names.add(f'{folder}/{job["name"]}')
+            self._add_jobs(f'{folder}/{job["name"]}', job)
+
+    def add(self, name: str):
+        self.names.add(name)
+
+    def __contains__(self, name: str) -> bool:
+        if name == self.root or name.startswith(self.root + '/'):
+            return name in self.names
+        return bool(self.server.job_exists(name))
+
+
+def config_digest(canonical_xml: str) -> str:
+    return sha256(canonical_xml.encode('utf-8')).hexdigest()
+
+
+class JenkinsConfigCache:
+    """
+      Digests of the canonical job configs we last pushed to, or found matching on, Jenkins. A job whose
+      rendered config has the same digest needn't be fetched and compared again, unless verifying everything.
+    """
+
+    def __init__(self, path: Path, verify_all: bool = False):
+        self.path = path
+        self.verify_all = verify_all
+        self.digests: Dict[str, str] = {}
+        if path.exists():
+            try:
+                with open(path) as cache_file:
+                    self.digests = json.load(cache_file)
+            except JSONDecodeError as e:
+                print(f'Warning: ignoring unreadable Jenkins config cache {path}:\n{e}')
+
+    def unchanged(self, job_url: str, digest: str) -> bool:
+        return not self.verify_all and self.digests.get(job_url, None) == digest
+
+    def record(self, job_url: str, digest: str):
+        self.digests[job_url] = digest
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(self.digests, cache_file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class JenkinsContext:
+    """
+      The Jenkins server, the jobs in the family's folder and the cache of job configs used throughout a sync.
+    """
+
+    def __init__(self, server: Jenkins, path: List[str], configs: JenkinsConfigCache, branch_ref: str):
+        self.server = server
+        self.path = path
+        self.jobs = JenkinsJobIndex(server, path)
+        self.configs = configs
+        self.branch_ref = branch_ref
+
+
+def plan_jenkins(plan: SyncPlan, jenkins: JenkinsContext, name: str, github_home: str, family_name: str):
+    def _plan_jenkins_job(full_job_name: str, xml_job_config: str):
+        config_xml_string = canonicalize_jenkins_xml(xml_job_config)
+        job_url = jenkins.server.server + full_job_name
+        digest = config_digest(config_xml_string)
+        if full_job_name not in jenkins.jobs:
+            print(f"Jenkins job {full_job_name} doesn't exist.")
+            plan.jenkins_change(name, 'create_job', full_job_name, config_xml_string, digest)
+        elif not jenkins.configs.unchanged(job_url, digest):
+            current_xml_string = canonicalize_jenkins_xml(jenkins.server.get_job_config(full_job_name))
+            # Most configs are identical, so only load xmldiff and work out the (much slower) structural diff when
+            # the digests differ
+            if config_digest(current_xml_string) == digest:
+                diffs = []
+            else:
+                diffs = load('xmldiff').diff_xml(current_xml_string, config_xml_string)
+            if len(diffs) == 0:
+                jenkins.configs.record(job_url, digest)
+            else:
+                print(f'Jenkins job {full_job_name} needs update')
+                plan.jenkins_change(name, 'reconfig_job', full_job_name, config_xml_string, digest, diffs)
+
+    def _plan_jenkins_folder(folder_path: str):
+        planned = any(change['action'] == 'create_folder' and change['job'] == folder_path
+                      for change in plan.jenkins)
+        if folder_path not in jenkins.jobs and not planned:
+            print(f'Jenkins folder at {folder_path} does not exist.')
+            plan.jenkins_change(name, 'create_folder', folder_path)
+
+    path = jenkins.path
+    branch_ref = jenkins.branch_ref
+
+    # The original Jenkins Job Template
+    job_template = Template(resources.read_text(templates, 'jenkins_job.xml'))
+    job_config_xml = job_template.substitute(github_home=github_home,
+                                             git_clone_url=github_home + '.git',
+                                             dataset_dir=name,
+                                             branch_ref=branch_ref)
+    _plan_jenkins_job('/'.join(path) + '/' + name, job_config_xml)
+
+    # The csvcubed-style Jenkins Job Templates
+    csvcubed_folder_path = '/'.join(path) + '/csvcubed'
+    csvcubed_job_folder_path = f'{csvcubed_folder_path}/{name}'
+    _plan_jenkins_folder(csvcubed_folder_path)
+    _plan_jenkins_folder(csvcubed_job_folder_path)
+
+    # CSV-W Generation Job
+    csvw_gen_job_template = Template(resources.read_text(templates, 'jenkins_job_csvcubed_generate_csvw.xml'))
+    csvw_gen_job_config_xml = csvw_gen_job_template.substitute(github_home=github_home,
+                                                               git_clone_url=github_home + '.git',
+                                                               dataset_dir=name,
+                                                               branch_ref=branch_ref)
+    _plan_jenkins_job(f'{csvcubed_job_folder_path}/{name}', csvw_gen_job_config_xml)
+
+    # Upload CSV-W to PMD Job
+    csvw2pmd_job_template = Template(resources.read_text(templates, 'jenkins_job_csvcubed_csvw2pmd.xml'))
+    family_name_path = pathify(family_name).lower()
+    csvw2pmd_job_config_xml = csvw2pmd_job_template.substitute(
+        csvw_gen_job_name=name,
+        graph_uri_base=f'http://gss-data.org.uk/graph/{family_name_path}/{name.lower()}',
+        resources_uri_base=f'http://gss-data.org.uk/data/{family_name_path}/{name.lower()}'
+    )
+    _plan_jenkins_job(f'{csvcubed_job_folder_path}/upload-to-pmd', csvw2pmd_job_config_xml)
+
+
+JENKINS_ACTION_ORDER = ['create_folder', 'create_job', 'reconfig_job']
+
+
+def apply_jenkins(plan: SyncPlan, jenkins: JenkinsContext, interactive: bool = True, workers: int = 1):
+    """
+      Create the planned folders, then jobs, up to `workers` at a time, then ask before updating the
+      configuration of each existing job. When not interactive, existing jobs are left for a later interactive
+      run.
+    """
+    server = jenkins.server
+
+    def _create_job(change: dict):
+        print(f'Creating new job {change["job"]}')
+        try:
+            server.create_job(change['job'], change['config'])
+            jenkins.jobs.add(change['job'])
+            jenkins.configs.record(server.server + change['job'], change['digest'])
+        except JenkinsException as e:
+            print(f'Failed creating job:\n{e}')
+
+    changes = sorted(plan.jenkins, key=lambda change: JENKINS_ACTION_ORDER.index(change['action']))
+    # Folders are created one at a time, in the order planned, so that each exists before anything inside it
+    for change in changes:
+        if change['action'] == 'create_folder' and change['job'] not in jenkins.jobs:
+            print(f'Creating folder {change["job"]}')
+            server.create_folder(change['job'])
+            jenkins.jobs.add(change['job'])
+    new_jobs = [change for change in changes if change['action'] == 'create_job' and change['job'] not in jenkins.jobs]
+    for _ in map_ordered(_create_job, new_jobs, workers):
+        pass
+    for change in changes:
+        if change['action'] != 'reconfig_job':
+            continue
+        full_job_name = change['job']
+        if not interactive:
+            print(f'Jenkins job {full_job_name} needs update, run repo-sync -j to review the changes.')
+            continue
+        print(json.dumps(change['diff'], indent=4))
+        if input(f'Are you sure you want to update configuration for {full_job_name} (y/n) ? ') == 'y':
+            print(f'Updating job configuration for {full_job_name}')
+            try:
+                server.reconfig_job(full_job_name, change['config'])
+                jenkins.configs.record(server.server + full_job_name, change['digest'])
+            except JenkinsException as e:
+                print(f'Failed updating job:\n{e}')
@@ -0,0 +1,8 @@
+from xmldiff.main import diff_texts
+
+
+def diff_xml(current: str, config: str) -> list:
+    """
+      Structural differences between two XML documents, as a list of xmldiff actions.
+    """
+    return diff_texts(current.encode('utf-8'), config.encode('utf-8'))
@@ -0,0 +1,253 @@
+import hmac
+import json
+import os
+import re
+import threading
+import time
+import traceback
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+
+try:
+    from .tracing import span
+except:
+    from tracing import span
+
+DAEMON_LISTEN = '127.0.0.1:8765'
+DAEMON_POLL = 600.0
+# Shared secret for change notifications: GitHub webhook signatures, or ?secret= for everything else
+WEBHOOK_SECRET_ENV = 'REPOSYNC_WEBHOOK_SECRET'
+ISSUE_API_PATH = re.compile(r'/repos/([^/]+/[^/]+)/issues/(\d+)$')
+
+
+class Changes:
+    """
+      What has been notified since the last sync cycle: Airtable edits, GitHub issues and project cards by
+      repository, or a request to reload and resync everything.
+    """
+
+    def __init__(self):
+        self.full = False
+        self.airtable = False
+        self.boards = False
+        self.issues: Dict[str, Set[int]] = {}
+
+    def empty(self) -> bool:
+        return not (self.full or self.airtable or self.boards or len(self.issues) > 0)
+
+    def describe(self) -> str:
+        if self.full:
+            return 'full resync'
+        parts = []
+        if self.airtable:
+            parts.append('Airtable')
+        if self.boards:
+            parts.append('project board')
+        for repo, numbers in self.issues.items():
+            parts.append(f'{repo} issues {", ".join(str(n) for n in sorted(numbers))}')
+        return ', '.join(parts)
+
+
+class SyncDaemon:
+    """
+      Keeps the family repositories, Airtable tables, GitHub issues and project board, and Jenkins jobs of a
+      sync in memory, listening on a local HTTP endpoint for notifications of changes. Only the datasets
+      affected by a change are then synced again, and everything is reloaded and synced every poll interval.
+
+        POST /airtable  Airtable has changed, e.g. from an automation or webhook
+        POST /github    a GitHub webhook, for issues, project, column or card events
+        POST /sync      reload everything
+        GET  /status    the state of the daemon, as JSON
+    """
+
+    def __init__(self, family_repos: list, services, args, load_family_repos: Callable[[], list],
+                 sync_family: Callable, address: Tuple[str, int], poll: float = DAEMON_POLL):
+        self.family_repos = family_repos
+        self.services = services
+        self.args = args
+        self.load_family_repos = load_family_repos
+        self.sync_family = sync_family
+        self.poll = poll if poll > 0 else None
+        self.secret = os.environ.get(WEBHOOK_SECRET_ENV, None)
+        self.changes = Changes()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.cycles = 0
+        self.last_cycle: Optional[dict] = None
+        self.server = ThreadingHTTPServer(address, WebhookHandler)
+        self.server.daemon_threads = True
+        self.server.sync_daemon = self
+        self._server_thread: Optional[threading.Thread] = None
+
+    def notify(self, update: Callable[[Changes], None]):
+        with self.lock:
+            update(self.changes)
+        self.wake.set()
+
+    def serve(self):
+        self._server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._server_thread.start()
+        host, port = self.server.server_address[:2]
+        print(f'Listening for changes on http://{host}:{port}/')
+        while True:
+            self.wake.wait(self.poll)
+            with self.lock:
+                changes, self.changes = self.changes, Changes()
+                self.wake.clear()
+            if changes.empty():
+                changes.full = True
+            self.cycle(changes)
+
+    def stop(self):
+        if self._server_thread is not None:
+            self.server.shutdown()
+        self.server.server_close()
+
+    def status(self) -> dict:
+        with self.lock:
+            pending = self.changes.describe()
+        return {
+            'families': [{'family': family.family_name, 'root': str(family.root)} for family in self.family_repos],
+            'cycles': self.cycles,
+            'last_cycle': self.last_cycle,
+            'pending': pending
+        }
+
+    def cycle(self, changes: Changes):
+        started = time.perf_counter()
+        print(f'Syncing after {changes.describe()}.')
+        errors = 0
+        try:
+            with span('daemon cycle', changes=changes.describe()):
+                previous = self.services.sources
+                if changes.full:
+                    self.family_repos = self.load_family_repos()
+                    self.services.fetch_families(self.family_repos, lookups=True)
+                else:
+                    # A full cycle reads every family afresh, otherwise pick up any edits or pulls since, before
+                    # going to Airtable, so that records they newly refer to are fetched too
+                    for family in self.family_repos:
+                        family.tree.refresh()
+                    new_records = any(record_id not in previous for family in self.family_repos
+                                      for record_id in family.tree.record_dirs)
+                    if changes.airtable or new_records:
+                        self.services.fetch_families(self.family_repos, lookups=False)
+                records = set(record_id for record_id, source in self.services.sources.items()
+                              if previous.get(record_id, None) != source)
+                for family in self.family_repos:
+                    datasets = self._issue_datasets(family, changes)
+                    if changes.boards:
+                        family.board_loaded = False
+                    if not changes.full and len(datasets) == 0 and len(records) == 0:
+                        continue
+                    try:
+                        with span(family.family_name, 'family'):
+                            if changes.full:
+                                self.sync_family(family, self.services, self.args)
+                            else:
+                                self.sync_family(family, self.services, self.args, records, datasets)
+                    except Exception:
+                        errors += 1
+                        print(f'Failed syncing {family.family_name} in {family.root}:')
+                        traceback.print_exc()
+                self.services.save()
+        except Exception:
+            errors += 1
+            traceback.print_exc()
+        elapsed = time.perf_counter() - started
+        self.cycles += 1
+        self.last_cycle = {'changes': changes.describe(), 'finished': time.time(), 'seconds': round(elapsed, 3),
+                           'errors': errors}
+        print(f'Synced in {elapsed:.2f}s.')
+
+    def _issue_datasets(self, family, changes: Changes) -> Set[str]:
+        """
+          Refresh the family's notified issues, returning the datasets whose main issue they are.
+        """
+        github = family.github
+        if github is None or github.repo.full_name not in changes.issues:
+            return set()
+        numbers = changes.issues[github.repo.full_name]
+        for number in numbers:
+            github.issues.forget(number)
+        return set(name for name, info in family.tree.infos.items()
+                   if info.get('transform', {}).get('main_issue', None) in numbers)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/status':
+            self._respond(200, self.server.sync_daemon.status())
+        else:
+            self._respond(404, {'error': 'not found'})
+
+    def do_POST(self):
+        daemon: SyncDaemon = self.server.sync_daemon
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path == '/github':
+            if not self._github_signed(daemon.secret, body):
+                self._respond(403, {'error': 'bad signature'})
+                return
+            try:
+                payload = json.loads(body or b'{}')
+            except ValueError:
+                self._respond(400, {'error': 'payload is not JSON'})
+                return
+            event = self.headers.get('X-GitHub-Event', '')
+            if event == 'ping':
+                self._respond(200, {'status': 'pong'})
+                return
+            daemon.notify(lambda changes: github_changes(changes, event, payload))
+        elif url.path in ('/airtable', '/sync'):
+            secret = parse_qs(url.query).get('secret', [''])[0]
+            if daemon.secret is not None and not hmac.compare_digest(secret, daemon.secret):
+                self._respond(403, {'error': 'bad secret'})
+                return
+            if url.path == '/airtable':
+                daemon.notify(lambda changes: setattr(changes, 'airtable', True))
+            else:
+                daemon.notify(lambda changes: setattr(changes, 'full', True))
+        else:
+            self._respond(404, {'error': 'not found'})
+            return
+        self._respond(202, {'status': 'queued'})
+
+    def _github_signed(self, secret: Optional[str], body: bytes) -> bool:
+        if secret is None:
+            return True
+        expected = 'sha256=' + hmac.new(secret.encode('utf-8'), body, sha256).hexdigest()
+        return hmac.compare_digest(self.headers.get('X-Hub-Signature-256', ''), expected)
+
+    def _respond(self, status: int, content: dict):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def github_changes(changes: Changes, event: str, payload: dict):
+    """
+      Record the issues affected by a GitHub webhook event. Project card events also mean the project board
+      needs reading again.
+    """
+    if event == 'issues' and 'issue' in payload:
+        repo = payload.get('repository', {}).get('full_name', None)
+        if repo is not None:
+            changes.issues.setdefault(repo, set()).add(payload['issue']['number'])
+    elif event == 'project_card':
+        changes.boards = True
+        match = ISSUE_API_PATH.search(payload.get('project_card', {}).get('content_url', None) or '')
+        if match is not None:
+            changes.issues.setdefault(match.group(1), set()).add(int(match.group(2)))
+    elif event in ('project', 'project_column'):
+        changes.boards = True
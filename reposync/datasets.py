@@ -0,0 +1,184 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import textwrap
+from collections import OrderedDict
+from json import JSONDecodeError
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from jsonschema import ValidationError
+
+try:
+    from .validation import ValidatorRegistry
+except:
+    from validation import ValidatorRegistry
+
+DATASET_SCHEMA = 'http://gss-cogs.github.io/family-schemas/dataset-schema.json'
+
+
+def pathify(label, segments=False):
+    """
+      Convert a label into something that can be used in a URI path segment.
+    """
+    return re.sub(r'-$', '',
+                  re.sub(r'-+', '-',
+                         re.sub(r'[^\w' + ('/]' if segments else ']'), '-', label)))
+
+
+def write_if_changed(path: Path, content: str, current: Optional[str] = None) -> bool:
+    """
+      Write content to a file, unless it already holds exactly that. The new content is written to a temporary
+      file which is then renamed over the original, so readers never see a partly written file. The current
+      content can be given if already known, to save reading the file again.
+    """
+    if current is None and path.exists():
+        with open(path, 'rb') as f:
+            current = f.read().decode('utf-8', errors='replace')
+    if current == content:
+        return False
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        if path.exists():
+            shutil.copymode(path, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+class DatasetTree:
+    """
+      The dataset directories of a family repository, with each directory's parsed and validated info.json and
+      the Airtable record IDs they refer to, read once per run, or again when changed on disk.
+    """
+
+    def __init__(self, root: Path, validators: ValidatorRegistry):
+        self.root = root
+        self.validators = validators
+        self.dirs: Set[str] = set()
+        self.files: Set[str] = set()
+        self.infos: Dict[str, OrderedDict] = {}
+        self.texts: Dict[str, str] = {}
+        self.read_errors: Dict[str, JSONDecodeError] = {}
+        self.validation_errors: Dict[str, ValidationError] = {}
+        self.record_dirs: Dict[str, str] = {}
+        self.duplicates: Dict[str, List[str]] = {}
+        # modification time and size of each info.json when last read or written
+        self.stats: Dict[str, Optional[Tuple[int, int]]] = {}
+        for entry in sorted(root.iterdir()):
+            if entry.is_dir():
+                self.dirs.add(entry.name)
+                self._read_info(entry.name)
+            else:
+                self.files.add(entry.name)
+        self._index_records()
+
+    def _stat(self, name: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = (self.root / name / 'info.json').stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read_info(self, name: str):
+        dataset_path = self.root / name
+        dataset_info_path = dataset_path / 'info.json'
+        self.stats[name] = self._stat(name)
+        if self.stats[name] is None:
+            return
+        with open(dataset_info_path, 'rb') as info_file:
+            text = info_file.read().decode('utf-8', errors='replace')
+        try:
+            dataset_info = json.loads(text, object_pairs_hook=OrderedDict)
+        except JSONDecodeError as e:
+            print(f'Warning: problem reading {dataset_info_path}:\n{e}')
+            self.read_errors[dataset_path.name] = e
+            return
+        self.texts[dataset_path.name] = text
+        try:
+            self.validators.validate(dataset_info, dataset_info.get('$schema', DATASET_SCHEMA))
+        except ValidationError as ve:
+            print(f'Error validating {dataset_info_path}:')
+            print(f'  {" / ".join(str(p) for p in ve.absolute_path)}: {textwrap.shorten(ve.message, width=120)}')
+            self.validation_errors[dataset_path.name] = ve
+        self.infos[dataset_path.name] = dataset_info
+
+    def _index_records(self):
+        self.record_dirs = {}
+        self.duplicates = {}
+        for name, dataset_info in sorted(self.infos.items()):
+            if 'transform' in dataset_info and 'airtable' in dataset_info['transform']:
+                record_ids = dataset_info['transform']['airtable']
+                if type(record_ids) != list:
+                    record_ids = [record_ids]
+                for record_id in record_ids:
+                    if record_id not in self.record_dirs:
+                        self.record_dirs[record_id] = name
+                    else:
+                        print(f'Warning: duplicate record ID {record_id} in {name} and {self.record_dirs[record_id]}')
+                        self.duplicates.setdefault(record_id, []).append(name)
+
+    def refresh(self) -> List[str]:
+        """
+          Read again the info.json files that have changed on disk since they were last read or written, e.g. by
+          a git pull or by hand, so that they aren't overwritten with what was read before. Returns the datasets
+          concerned.
+        """
+        names = set(self.stats)
+        for entry in self.root.iterdir():
+            if entry.is_dir():
+                names.add(entry.name)
+        changed = sorted(name for name in names if self._stat(name) != self.stats.get(name, None))
+        for name in changed:
+            for state in (self.infos, self.texts, self.read_errors, self.validation_errors):
+                state.pop(name, None)
+            if (self.root / name).is_dir():
+                self.dirs.add(name)
+            else:
+                self.dirs.discard(name)
+            self._read_info(name)
+        if len(changed) > 0:
+            print(f'Read {len(changed)} info.json file(s) changed on disk: {", ".join(changed)}')
+            self._index_records()
+        return changed
+
+    def stages(self) -> Set[str]:
+        """
+          Tech stages recorded in the local info.json files.
+        """
+        return set(stage for info in self.infos.values() for stage in info.get('transform', {}).get('stage', []))
+
+    def info(self, name: str) -> OrderedDict:
+        """
+          The info for a dataset directory, starting with an empty info if needed. The same object is returned
+          each time, so updates are seen by later lookups within the run.
+        """
+        return self.infos.setdefault(name, OrderedDict())
+
+    def info_changed(self, name: str) -> bool:
+        """
+          Whether a dataset's info differs from what was read from disk.
+        """
+        return json.dumps(self.infos[name], indent=4) != self.texts.get(name, None)
+
+    def write_info(self, name: str) -> bool:
+        """
+          Write out a dataset's info.json if it differs from what is on disk, returning whether it changed. The
+          dataset directory is created if needed.
+        """
+        if name not in self.dirs:
+            (self.root / name).mkdir(parents=True, exist_ok=True)
+            self.dirs.add(name)
+        content = json.dumps(self.infos[name], indent=4)
+        changed = write_if_changed(self.root / name / 'info.json', content, self.texts.get(name, None))
+        self.texts[name] = content
+        self.stats[name] = self._stat(name)
+        return changed
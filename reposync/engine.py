@@ -0,0 +1,77 @@
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, TypeVar
+
+Item = TypeVar('Item')
+Result = TypeVar('Result')
+
+
+class _ThreadOutput(io.TextIOBase):
+    """
+      Stands in for sys.stdout, sending what each worker thread prints to that thread's buffer, and anything
+      else straight through.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def capture(self, work: Callable, item):
+        self.local.buffer = io.StringIO()
+        try:
+            return work(item), self.local.buffer.getvalue(), None
+        except Exception as e:
+            return None, self.local.buffer.getvalue(), e
+        finally:
+            self.local.buffer = None
+
+
+@contextmanager
+def _thread_output():
+    output = _ThreadOutput(sys.stdout)
+    sys.stdout = output
+    try:
+        yield output
+    finally:
+        sys.stdout = output.stream
+
+
+def map_ordered(work: Callable[[Item], Result], items: Iterable[Item], workers: int) -> Iterator[Result]:
+    """
+      Apply work to each item on a pool of threads, yielding the results in the order of the items. What each
+      item's work prints is held back and printed in the same order, so the output reads as if the items had
+      been worked through one at a time. An exception raised by the work for an item is raised once the items
+      before it have been yielded.
+
+      How many requests go to each service at once is limited by the service's scheduler, not here.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield work(item)
+        return
+    with _thread_output() as output, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(output.capture, work, item) for item in items]
+        try:
+            for future in futures:
+                result, printed, error = future.result()
+                output.stream.write(printed)
+                if error is not None:
+                    raise error
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
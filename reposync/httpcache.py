@@ -0,0 +1,148 @@
+import base64
+import json
+import os
+import threading
+from hashlib import sha256
+from pathlib import Path
+from typing import Optional
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+# Headers describing the body as sent, which no longer apply to the decoded body we keep
+UNCACHED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive'}
+# Header added to responses served from the cache, saying how
+CACHE_HEADER = 'X-Reposync-Cache'
+
+
+class HTTPCache:
+    """
+      On-disk cache of GET responses that came with an ETag or Last-Modified date, one file per response.
+      Entries are only ever used after revalidating them with a conditional request, so they can't go stale,
+      and the least recently used are evicted once the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+    def key(self, request: requests.PreparedRequest) -> str:
+        # Responses depend on who is asking and in what format, so keep them apart by token and Accept header
+        vary = '\n'.join([request.method, request.url, request.headers.get('Authorization', ''),
+                          request.headers.get('Accept', '')])
+        return sha256(vary.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f'{key}.json'
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            with open(path) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        try:
+            # the modification time records when an entry was last used, for evicting the least recently used
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key: str, response: requests.Response):
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in UNCACHED_HEADERS}
+        entry = json.dumps({'url': response.url, 'status': response.status_code, 'headers': headers,
+                            'body': base64.b64encode(response.content).decode('ascii')})
+        path = self._path(key)
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            size = self._current_size()
+            if path.exists():
+                size -= path.stat().st_size
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as entry_file:
+                entry_file.write(entry)
+            os.replace(tmp_path, path)
+            self._size = size + len(entry)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _current_size(self) -> int:
+        if self._size is None:
+            self._size = sum(entry.stat().st_size for entry in self.directory.glob('*.json'))
+        return self._size
+
+    def _evict(self):
+        """
+          Remove the least recently used entries until the cache is back to 90% of its maximum size, leaving
+          room to grow before evicting again.
+        """
+        entries = sorted((stat.st_mtime, stat.st_size, entry)
+                         for entry, stat in ((entry, entry.stat()) for entry in self.directory.glob('*.json')))
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, entry in entries:
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                entry.unlink()
+                size -= entry_size
+            except OSError:
+                pass
+        self._size = size
+
+
+class CachingAdapter(BaseAdapter):
+    """
+      Transport adapter that revalidates cached GET responses with If-None-Match and If-Modified-Since, turning
+      a 304 Not Modified into the cached response, and caches new responses that can be revalidated. Requests
+      are sent through the given adapter.
+    """
+
+    def __init__(self, cache: HTTPCache, adapter: Optional[BaseAdapter] = None):
+        super().__init__()
+        self.cache = cache
+        self.adapter = adapter if adapter is not None else HTTPAdapter()
+
+    def close(self):
+        self.adapter.close()
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if request.method != 'GET' or kwargs.get('stream', False):
+            return self.adapter.send(request, **kwargs)
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+        if entry is not None and 'If-None-Match' not in request.headers and \
+                'If-Modified-Since' not in request.headers:
+            cached_headers = CaseInsensitiveDict(entry['headers'])
+            if 'ETag' in cached_headers:
+                request.headers['If-None-Match'] = cached_headers['ETag']
+            if 'Last-Modified' in cached_headers:
+                request.headers['If-Modified-Since'] = cached_headers['Last-Modified']
+        response = self.adapter.send(request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            return self._cached_response(request, response, entry)
+        if response.status_code == 200 and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            self.cache.put(key, response)
+        return response
+
+    def _cached_response(self, request: requests.PreparedRequest, not_modified: requests.Response,
+                         entry: dict) -> requests.Response:
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = 'OK'
+        # the 304's headers are the current ones, e.g. the rate limit remaining
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.headers.update((name, value) for name, value in not_modified.headers.items()
+                                if name.lower() not in UNCACHED_HEADERS)
+        response.headers[CACHE_HEADER] = 'revalidated'
+        response._content = base64.b64decode(entry['body'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = entry['url']
+        response.request = request
+        response.connection = self
+        response.elapsed = not_modified.elapsed
+        not_modified.close()
+        return response
@@ -0,0 +1,89 @@
+import json
+from typing import List, Optional, Set, Tuple
+
+
+class SyncPlan:
+    """
+      The changes needed to bring GitHub, Airtable, Jenkins and the local info.json files in line with Airtable,
+      worked out before any of them are made, so that they can be shown as a dry run or applied service by
+      service in batches.
+
+      Each change is a plain dict, so the plan can be printed as JSON. Changes for an issue that doesn't exist
+      yet refer to it by dataset, as its number is only known once created.
+    """
+
+    def __init__(self):
+        # {'dataset', 'title', 'labels', 'todo', 'records'}
+        self.issues: List[dict] = []
+        # {'dataset', 'issue', 'add', 'remove'}
+        self.labels: List[dict] = []
+        # {'dataset', 'issue', 'column'}
+        self.cards: List[dict] = []
+        # {'dataset', 'record', 'fields'}
+        self.airtable: List[dict] = []
+        # {'dataset', 'action': 'create_folder' | 'create_job' | 'reconfig_job', 'job', 'config', 'digest', 'diff'}
+        self.jenkins: List[dict] = []
+        # {'dataset', 'path'}
+        self.files: List[dict] = []
+        self._jenkins_jobs: Set[Tuple[str, str]] = set()
+
+    def new_issue(self, dataset: str, title: str, labels: List[str], todo: bool, record: str):
+        # Several sources can share a dataset directory, and so its issue; the last source's stages win.
+        issue = next((issue for issue in self.issues if issue['title'] == title), None)
+        if issue is None:
+            self.issues.append({'dataset': dataset, 'title': title, 'labels': labels, 'todo': todo,
+                                'records': [record]})
+        else:
+            issue.update(labels=labels, todo=todo)
+            issue['records'].append(record)
+
+    def set_labels(self, dataset: str, issue: int, add: List[str], remove: List[str]):
+        self.labels = [change for change in self.labels if change['issue'] != issue]
+        if len(add) > 0 or len(remove) > 0:
+            self.labels.append({'dataset': dataset, 'issue': issue, 'add': add, 'remove': remove})
+
+    def add_card(self, dataset: str, issue: int, column: str):
+        if not any(card['issue'] == issue for card in self.cards):
+            self.cards.append({'dataset': dataset, 'issue': issue, 'column': column})
+
+    def update_record(self, dataset: str, record: str, fields: dict):
+        self.airtable.append({'dataset': dataset, 'record': record, 'fields': fields})
+
+    def jenkins_change(self, dataset: str, action: str, job: str, config: Optional[str] = None,
+                       digest: Optional[str] = None, diff: Optional[list] = None):
+        # Datasets planned separately can each find the same shared folder missing
+        if (action, job) in self._jenkins_jobs:
+            return
+        self._jenkins_jobs.add((action, job))
+        self.jenkins.append({'dataset': dataset, 'action': action, 'job': job, 'config': config, 'digest': digest,
+                             'diff': diff})
+
+    def write_file(self, dataset: Optional[str], path: str):
+        if not any(f['path'] == path for f in self.files):
+            self.files.append({'dataset': dataset, 'path': path})
+
+    def extend(self, other: 'SyncPlan'):
+        for issue in other.issues:
+            for record in issue['records']:
+                self.new_issue(issue['dataset'], issue['title'], issue['labels'], issue['todo'], record)
+        for change in other.labels:
+            self.set_labels(change['dataset'], change['issue'], change['add'], change['remove'])
+        for card in other.cards:
+            self.add_card(card['dataset'], card['issue'], card['column'])
+        self.airtable.extend(other.airtable)
+        for change in other.jenkins:
+            self.jenkins_change(change['dataset'], change['action'], change['job'], change['config'],
+                                change['digest'], change['diff'])
+        for f in other.files:
+            self.write_file(f['dataset'], f['path'])
+
+    def to_dict(self) -> dict:
+        return {
+            'github': {'issues': self.issues, 'labels': self.labels, 'cards': self.cards},
+            'airtable': self.airtable,
+            'jenkins': [{key: value for key, value in change.items() if key != 'config'} for change in self.jenkins],
+            'files': self.files
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=4)
@@ -0,0 +1,188 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+
+# Methods that can safely be sent again after a server error or dropped connection. The PATCHes we send set
+# field values, so repeating them is harmless.
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'PATCH'}
+TRANSIENT_STATUSES = {500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+      Hands out tokens across threads at no more than `rate` per second, allowing bursts of up to `burst`, or
+      without limit if rate is None. The bucket can be paused, e.g. while a service asks us to back off.
+    """
+
+    def __init__(self, rate: Optional[float], burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+class Service:
+    """
+      The request limits of a remote service, shared by all the clients and threads talking to it: a token
+      bucket for all requests, optionally a slower one for writes and a cap on the requests in flight at once,
+      and the (connect, read) timeouts to send them with. Responses asking us to slow down, through a 429,
+      Retry-After or an exhausted X-RateLimit-Remaining, pause the service's buckets, so that other services
+      carry on meanwhile.
+    """
+
+    def __init__(self, name: str, rate: Optional[float], burst: int = 1, write_rate: Optional[float] = None,
+                 throttle_wait: float = 30.0, retries: int = 5, backoff: float = 1.0, max_backoff: float = 60.0,
+                 concurrency: Optional[int] = None, timeout: Optional[Tuple[float, float]] = None):
+        self.name = name
+        self.requests = TokenBucket(rate, burst)
+        self.writes = TokenBucket(write_rate) if write_rate is not None else None
+        self.concurrency = concurrency
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency is not None else None
+        self.timeout = timeout
+        self._adapter: Optional[ScheduledAdapter] = None
+        self._adapter_lock = threading.Lock()
+        self.throttle_wait = throttle_wait
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def acquire(self, method: str):
+        if self.writes is not None and method not in ('GET', 'HEAD', 'OPTIONS'):
+            self.writes.acquire()
+        self.requests.acquire()
+
+    def pause(self, seconds: float):
+        self.requests.pause(seconds)
+        if self.writes is not None:
+            self.writes.pause(seconds)
+
+    def retry_delay(self, attempt: int) -> float:
+        """
+          Exponential backoff with jitter, so that clients retrying at once don't all come back together.
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def throttled(self, response: requests.Response) -> Optional[float]:
+        """
+          How long the service has asked us to wait before trying again, if the response says we've been
+          throttled.
+        """
+        retry_after = _retry_after(response)
+        remaining = response.headers.get('X-RateLimit-Remaining', None)
+        if response.status_code == 429 or (response.status_code == 403 and (retry_after is not None or
+                                                                            remaining == '0')):
+            if retry_after is not None:
+                return retry_after
+            if remaining == '0' and 'X-RateLimit-Reset' in response.headers:
+                return max(float(response.headers['X-RateLimit-Reset']) - time.time(), 0) + 1
+            return self.throttle_wait
+        return None
+
+    def adapter(self) -> 'ScheduledAdapter':
+        """
+          The service's transport adapter, shared by all its clients, so that they draw on one pool of keep-alive
+          connections per host, and only connect, and shake hands over TLS, once per host in a run.
+        """
+        with self._adapter_lock:
+            if self._adapter is None:
+                pool_size = self.concurrency if self.concurrency is not None else DEFAULT_POOLSIZE
+                self._adapter = ScheduledAdapter(self, pool_maxsize=pool_size)
+        return self._adapter
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    value = response.headers.get('Retry-After', None)
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+class ScheduledAdapter(HTTPAdapter):
+    """
+      Transport adapter sending each request when its service's limits allow, with the service's timeouts in
+      place of whatever the client asked for, and trying again, after waiting, when throttled, or with jittered
+      backoff after a transient error.
+    """
+
+    def __init__(self, service: Service, **kwargs):
+        super().__init__(**kwargs)
+        self.service = service
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        service = self.service
+        if service.timeout is not None:
+            kwargs['timeout'] = service.timeout
+        attempt = 0
+        while True:
+            service.acquire(request.method)
+            try:
+                if service.slots is None:
+                    response = super().send(request, **kwargs)
+                else:
+                    with service.slots:
+                        response = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # A request that never reached the service can always be sent again
+                never_sent = isinstance(e, requests.exceptions.ConnectTimeout)
+                if attempt >= service.retries or not (never_sent or request.method in IDEMPOTENT_METHODS):
+                    raise
+                delay = service.retry_delay(attempt)
+                print(f'{service.name} request failed, retrying in {delay:.1f}s: {e}')
+            else:
+                wait = service.throttled(response)
+                if wait is not None:
+                    if attempt >= service.retries:
+                        return response
+                    # A throttled request wasn't acted on, so can be sent again whatever its method
+                    service.pause(wait)
+                    print(f'{service.name} asked us to slow down, waiting {wait:.1f}s.')
+                    delay = 0
+                elif response.status_code in TRANSIENT_STATUSES and request.method in IDEMPOTENT_METHODS \
+                        and attempt < service.retries:
+                    delay = _retry_after(response) or service.retry_delay(attempt)
+                    print(f'{service.name} returned {response.status_code}, retrying in {delay:.1f}s.')
+                else:
+                    remaining = response.headers.get('X-RateLimit-Remaining', None)
+                    if remaining == '0' and 'X-RateLimit-Reset' in response.headers:
+                        # That was the last request allowed until the limit resets, so hold the next one back
+                        service.pause(max(float(response.headers['X-RateLimit-Reset']) - time.time(), 0) + 1)
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
@@ -1,54 +1,85 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import json
 import os
-import re
 import shutil
-import textwrap
-from collections import defaultdict, OrderedDict
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from difflib import Differ
-from functools import lru_cache
 from importlib import resources
-from io import BytesIO
-from json import JSONDecodeError
 from pathlib import Path
-from string import Template
-from sys import stderr
-from typing import Dict, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Set
 
-import jsonschema
 import requests
 from airtable import Airtable
-from github import Github, UnknownObjectException
-from github.Issue import Issue
-from github.ProjectColumn import ProjectColumn
-from jenkins import Jenkins, JenkinsException
-from jsonschema import ValidationError
-from lxml.etree import canonicalize, parse, tostring
-from progress.bar import Bar
-from xmldiff.main import diff_texts, diff_files
-from git import Repo
 
 try:
-    from . import templates
+    from . import backends, templates
+    from .daemon import DAEMON_LISTEN, DAEMON_POLL, SyncDaemon
+    from .datasets import DatasetTree, pathify, write_if_changed
+    from .engine import map_ordered
+    from .httpcache import HTTPCache
+    from .plan import SyncPlan
+    from .ratelimit import Service
+    from .snapshot import AirtableSnapshot, fetch_records, fetch_records_by_id
+    from .tracing import TRACER, span
+    from .validation import SchemaResolver, ValidatorRegistry
 except:
+    import backends
     import templates
+    from daemon import DAEMON_LISTEN, DAEMON_POLL, SyncDaemon
+    from datasets import DatasetTree, pathify, write_if_changed
+    from engine import map_ordered
+    from httpcache import HTTPCache
+    from plan import SyncPlan
+    from ratelimit import Service
+    from snapshot import AirtableSnapshot, fetch_records, fetch_records_by_id
+    from tracing import TRACER, span
+    from validation import SchemaResolver, ValidatorRegistry
+
+# The GitHub, Jenkins, XML diff and Git backends are only imported when a family uses them
+if TYPE_CHECKING:
+    from github import Github
+    from jenkins import Jenkins
+    from .backends.github import GitHubContext
+    from .backends.jenkins import JenkinsConfigCache, JenkinsContext
 
 REPOSYNC_CONFIG = Path.home() / '.config' / 'reposync'
 AIRTABLE_TOKEN_FILE = REPOSYNC_CONFIG / 'airtable-token'
 AIRTABLE_BASE = 'appb66460atpZjzMq'
+# Airtable allows 5 requests per second per base, shared between all the tables we fetch concurrently, and
+# after a 429 asks for 30 seconds' grace
+AIRTABLE_WORKERS = 4
+AIRTABLE_SERVICE = Service('Airtable', rate=5, throttle_wait=30, concurrency=AIRTABLE_WORKERS, timeout=(5, 30))
 GITHUB_TOKEN_FILE = REPOSYNC_CONFIG / 'github-token'
 JENKINS_TOKEN_FILE = REPOSYNC_CONFIG / 'jenkins-token'
-
-
-def pathify(label, segments=False):
-    """
-      Convert a label into something that can be used in a URI path segment.
-    """
-    return re.sub(r'-$', '',
-                  re.sub(r'-+', '-',
-                         re.sub(r'[^\w' + ('/]' if segments else ']'), '-', label)))
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+GITHUB_GRAPHQL_URL = os.environ.get('GITHUB_GRAPHQL_URL', 'https://api.github.com/graphql')
+GITHUB_POOL_SIZE = 4
+# GitHub's secondary limits allow around 900 REST requests a minute, and ask for a second between writes and
+# for requests not to be made concurrently, so keep to the few connections in the client's pool
+GITHUB_SERVICE = Service('GitHub', rate=15, burst=15, write_rate=1, throttle_wait=60, concurrency=GITHUB_POOL_SIZE,
+                         timeout=(5, 30))
+# GraphQL queries are POSTs, but only read, and are limited separately
+GITHUB_GRAPHQL_SERVICE = Service('GitHub GraphQL', rate=15, burst=15, throttle_wait=60, concurrency=GITHUB_POOL_SIZE,
+                                 timeout=(5, 30))
+# Jenkins has no rate limits, but is retried after transient errors. Creating a job can keep it busy for a while.
+JENKINS_SERVICE = Service('Jenkins', rate=None, throttle_wait=5, concurrency=8, timeout=(5, 60))
+# Datasets planned, and Jenkins jobs created, at once
+DATASET_WORKERS = 8
+GITHUB_CACHE_DIR = REPOSYNC_CONFIG / 'github-cache'
+GITHUB_CACHE_MB = 100
+SNAPSHOT_DIR = REPOSYNC_CONFIG / 'snapshots'
+JENKINS_CONFIG_CACHE = REPOSYNC_CONFIG / 'jenkins-configs.json'
+SCHEMA_CACHE_DIR = REPOSYNC_CONFIG / 'schemas'
+PIPELINES_SCHEMA = 'http://gss-cogs.github.io/family-schemas/pipelines-schema.json'
+# 'Source Data' fields read by update_info, plan_github and sync
+SOURCE_FIELDS = ['Name', 'Producer', 'Description', 'Landing Page', 'Route from landing page to data',
+                 'Last Published', 'Family', 'Data type', 'BA Stage', 'Tech Stage', 'Sizing Notes', 'Notes',
+                 'GitHub Issue Number', 'GitHub Issue URL']
 
 
 def update_info(info, source, producers, families, types, source_ids, touched, directory):
@@ -97,208 +128,403 @@ def update_info(info, source, producers, families, types, source_ids, touched, d
     info['notes'] = source.get('Notes', '').strip()
 
 
-GITHUB_BASE = 'https://github.com/'
-
-
-def get_project_board(github_token, repo_url, project_url):
-    if not repo_url.startswith(GITHUB_BASE):
-        print(f'Github repo URL not recognised {repo_url}.')
-        return None
-    g = Github(github_token)
-    try:
-        repo = g.get_repo(repo_url[len(GITHUB_BASE):])
-    except UnknownObjectException:
-        print(f'Unknown repo {repo_url[len(GITHUB_BASE):]}')
-        return
-    org = g.get_organization(repo.organization.login)
-    return next((project for project in org.get_projects()
-                 if (project_url is not None and getattr(project, 'html_url', None) == project_url) or
-                    (project_url is None and project.name == 'Transformation Pipelines')), None)
-
-
-def update_github(issue_no, title, source, github_token, repo_url, writeback, rec_id, used_labels, issue_column,
-                  todo_column):
-    if not repo_url.startswith(GITHUB_BASE):
-        print(f'Github repo URL not recognised {repo_url}.')
-        return None, None
-    elif issue_no is not None and issue_no <= 0:
-        print(f'Github issue number not valid: {issue_no}.')
-        return None, None
-    else:
-        g = Github(github_token)
-        try:
-            repo = g.get_repo(repo_url[len(GITHUB_BASE):])
-        except UnknownObjectException:
-            print(f'Unknown repo {repo_url[len(GITHUB_BASE):]}')
-            return None, None
-        if issue_no is None:
-            # search through issues for a match against the expected title
-            issue = next((i for i in repo.get_issues() if i.title == title), None)
-            if issue is None:
-                print(f"Need to create new GitHub issue for {title}")
-                if writeback:
-                    issue = repo.create_issue(
-                        title,
-                        body=resources.read_text(templates, 'issue_body.md')
-                    )
-        else:
-            issue = repo.get_issue(number=issue_no)
-        if issue is None:
-            print(f'No GitHub issue for {title}')
-            return None, None
-        if issue_no is None:
-            issue_no = issue.number
-        airtable_labels = set(
-            [label.name for label in issue.get_labels() if label.name in used_labels])
-        if 'Tech Stage' in source:
-            stage_labels = set(source['Tech Stage'])
-            to_remove = airtable_labels - stage_labels
-            to_add = stage_labels - airtable_labels
-            if len(to_remove) > 0:
-                print(f'Need to remove "{", ".join(to_remove)}" from issue {issue_no}')
-                if writeback:
-                    for label in to_remove:
-                        issue.remove_from_labels(label)
-                        print(f'Removed "{label}".')
-            if len(to_add) > 0:
-                print(f'Need to add "{", ".join(to_add)}" for issue {issue_no}')
-                if writeback:
-                    for label in to_add:
-                        issue.add_to_labels(label)
-                        print(f'Added "{label}".')
-            if issue_no not in issue_column and 'To Do' in stage_labels and issue.state == 'open':
-                print(f'Issue {issue_no} is not on project board and should be in To Do column.')
-                if writeback:
-                    card = todo_column.create_card(content_id=issue.id, content_type='Issue')
-                    card.move('top', todo_column)
-        return issue.number, issue.html_url
-
-
-def update_web_pages(root_dir):
+def update_web_pages(tree: DatasetTree):
     for resource in resources.contents(templates):
         if resource.endswith('.html') or resource.endswith('.js') or resource.endswith('.hbs'):
-            if resource == 'index.html' and (root_dir / resource).exists():
+            if resource == 'index.html' and resource in tree.files:
                 continue
             with resources.path(templates, resource) as file_path:
-                shutil.copy(file_path, root_dir / resource)
+                shutil.copy(file_path, tree.root / resource)
+
 
+class PacedAirtable(Airtable):
+    """
+      Airtable client whose requests are paced, and retried when throttled, by a service scheduler shared
+      across tables, rather than by sleeping after each page, and sent over the service's pooled connections.
+      The API URL can be overridden, e.g. to point at a local stand-in.
+    """
+    API_LIMIT = 0
+    API_URL = os.environ.get('AIRTABLE_API_URL', Airtable.API_URL)
 
-def canonicalize_jenkins_xml(xml: str) -> str:
-    def _extract_plugin_name(plugin_name_and_maybe_version: str) -> str:
-        parts = plugin_name_and_maybe_version.split('@')
+    def __init__(self, base_id, table_name, api_key, service=AIRTABLE_SERVICE, **kwargs):
+        super().__init__(base_id, table_name, api_key, **kwargs)
+        self.session.mount(self.API_URL, service.adapter())
 
-        if len(parts) == 1:
-            return parts[0]
-        elif len(parts) > 1:
-            return parts[:-1]
-        else:
-            raise Exception(f'Invalid plugin name found: {plugin_name_and_maybe_version}')
 
-    tree = parse(BytesIO(bytearray(xml, 'utf-8')))
-    for node_with_plugin in tree.xpath('//node()[@plugin]'):
-        plugin_without_version = ''.join(_extract_plugin_name(node_with_plugin.get('plugin')))
-        node_with_plugin.set('plugin', plugin_without_version)
-    return canonicalize(tree)
+def fetch_table(token, table_name, full_refresh=False, **options):
+    with span(f'fetch {table_name}', 'airtable'):
+        snapshot = AirtableSnapshot(SNAPSHOT_DIR, AIRTABLE_BASE, table_name, **options).load()
+        return fetch_records(PacedAirtable(AIRTABLE_BASE, table_name, api_key=token), snapshot,
+                             full_refresh=full_refresh, **options)
 
 
-def update_jenkins(base: str, path: list[str], creds: dict, name: str, writeback: bool, github_home: str,
-                   branch_ref: str, family_name: str):
-    def _upsert_jenkins_job(server: Jenkins, full_job_name: str, xml_job_config: str):
-        if server.job_exists(full_job_name):
-            job = server.get_job_info(full_job_name)
-        else:
-            print(f'Jenkins job {full_job_name} doesn''t exist.')
-            job = None
-        config_xml_string = canonicalize_jenkins_xml(xml_job_config)
-        if job is None and writeback:
-            print(f'Creating new job {full_job_name}')
+def airtable_string(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def family_formula(family_names):
+    """
+      Airtable formula matching records linked to any of the named families. Linked records are joined by their
+      names, so this can over-match a family whose name contains a comma; callers still check the family IDs.
+    """
+    return 'OR(' + ', '.join(f"FIND(',' & {airtable_string(name)} & ',', ',' & ARRAYJOIN({{Family}}, ',') & ',')"
+                             for name in family_names) + ')'
+
+
+def fetch_sources(token, family_names, record_ids, full_refresh=False):
+    """
+      Fetch just the fields we use for the 'Source Data' records in the given families, along with any other
+      records already referenced by local datasets.
+    """
+    sources = fetch_table(token, 'Source Data', full_refresh,
+                          formula=family_formula(family_names), fields=SOURCE_FIELDS)
+    others = [rec_id for rec_id in record_ids if rec_id not in sources]
+    if len(others) > 0:
+        sources.update(fetch_records_by_id(PacedAirtable(AIRTABLE_BASE, 'Source Data', api_key=token), others,
+                                           fields=SOURCE_FIELDS))
+    return sources
+
+
+class AirtableUpdates:
+    """
+      Field updates to Airtable records, queued up during the sync and sent as batch updates of as many records
+      per request as Airtable allows.
+    """
+
+    def __init__(self, airtable: Airtable):
+        self.airtable = airtable
+        self.pending: Dict[str, dict] = OrderedDict()
+
+    def queue(self, rec_id, fields):
+        self.pending.setdefault(rec_id, {}).update(fields)
+
+    def flush(self):
+        records = [{'id': rec_id, 'fields': fields} for rec_id, fields in self.pending.items()]
+        self.pending = OrderedDict()
+        updated = 0
+        for i in range(0, len(records), self.airtable.MAX_RECORDS_PER_REQUEST):
+            batch = records[i:i + self.airtable.MAX_RECORDS_PER_REQUEST]
             try:
-                server.create_job(full_job_name, config_xml_string)
-            except JenkinsException as e:
-                print(f'Failed creating job:\n{e}')
-        elif job is not None:
-            current_xml_string = canonicalize_jenkins_xml(server.get_job_config(full_job_name))
-            diffs = diff_files(BytesIO(bytearray(current_xml_string, encoding='utf-8')),
-                               BytesIO(bytearray(config_xml_string, encoding='utf-8')))
-            if len(diffs) > 0:
-                print(f'Jenkins job {full_job_name} needs update')
-                if writeback:
-                    print(json.dumps(diffs, indent=4))
-                    if input(f'Are you sure you want to update configuration for {full_job_name} (y/n) ? ') == 'y':
-                        print(f'Updating job configuration for {full_job_name}')
-                        try:
-                            server.reconfig_job(full_job_name, config_xml_string)
-                        except JenkinsException as e:
-                            print(f'Failed updating job:\n{e}')
-
-    def _ensure_jenkins_folder_exists(server: Jenkins, folder_path: str) -> bool:
-        if server.job_exists(folder_path):
-            return True
-        elif writeback:
-            server.create_folder(folder_path)
-            return True
-
-        print(f'Jenkins folder at {csvcubed_folder_path} does not exist.')
-        return False
-
-    jenkins_server = Jenkins(base, username=creds['username'], password=creds['token'], timeout=10000)
-
-    # Upsert the original Jenkins Job Template
-    job_template = Template(resources.read_text(templates, 'jenkins_job.xml'))
-    job_config_xml = job_template.substitute(github_home=github_home,
-                                             git_clone_url=github_home + '.git',
-                                             dataset_dir=name,
-                                             branch_ref=branch_ref)
-    _upsert_jenkins_job(jenkins_server, '/'.join(path) + '/' + name, job_config_xml)
-
-    # Upsert the csvcubed-style Jenkins Job Templates
-    csvcubed_folder_path = '/'.join(path) + '/csvcubed'
-    csvcubed_job_folder_path = f'{csvcubed_folder_path}/{name}'
-    if (_ensure_jenkins_folder_exists(jenkins_server, csvcubed_folder_path) and
-            _ensure_jenkins_folder_exists(jenkins_server, csvcubed_job_folder_path)):
-
-        # CSV-W Generation Job
-        csvw_gen_job_template = Template(resources.read_text(templates, 'jenkins_job_csvcubed_generate_csvw.xml'))
-        csvw_gen_job_config_xml = csvw_gen_job_template.substitute(github_home=github_home,
-                                                                   git_clone_url=github_home + '.git',
-                                                                   dataset_dir=name,
-                                                                   branch_ref=branch_ref)
-        _upsert_jenkins_job(jenkins_server, f'{csvcubed_job_folder_path}/{name}', csvw_gen_job_config_xml)
-
-        # Upload CSV-W to PMD Job
-        csvw2pmd_job_template = Template(resources.read_text(templates, 'jenkins_job_csvcubed_csvw2pmd.xml'))
-        family_name_path = pathify(family_name).lower()
-        csvw2pmd_job_config_xml = csvw2pmd_job_template.substitute(
-            csvw_gen_job_name=name,
-            graph_uri_base=f'http://gss-data.org.uk/graph/{family_name_path}/{name.lower()}',
-            resources_uri_base=f'http://gss-data.org.uk/data/{family_name_path}/{name.lower()}'
-        )
-
-        _upsert_jenkins_job(jenkins_server, f'{csvcubed_job_folder_path}/upload-to-pmd', csvw2pmd_job_config_xml)
-    else:
-        print('Could not ensure csvcubed configuration exists. Parent folders do not exist. '
-              'Re-run with jenkins flag `-j` set to create said folders and jobs.')
+                self.airtable.batch_update(batch)
+                updated += len(batch)
+            except requests.exceptions.HTTPError:
+                # Airtable rejects the whole batch if any one record fails, so find out which by sending
+                # them individually.
+                for record in batch:
+                    try:
+                        self.airtable.update(record['id'], record['fields'])
+                        updated += 1
+                    except requests.exceptions.HTTPError as e:
+                        print(f'Failed updating Airtable record {record["id"]}:\n{e}')
+        if len(records) > 0:
+            print(f'Updated {updated} of {len(records)} Airtable records.')
+        return updated
 
 
-def update_airtable_issue(token, issue_number, issue_url, rec_id):
-    source = Airtable(AIRTABLE_BASE, 'Source Data', api_key=token)
-    # Turn the Key and new Value into a Dictionary
-    update = {
-        'GitHub Issue Number': issue_number,
-        'GitHub Issue URL': issue_url
-    }
-    # Update AirTable with the new details using the Table name and record ID
-    Airtable.update(source, rec_id, update)
+def plan_dataset(plan: SyncPlan, tree: DatasetTree, dataset_dir, sources, producers, families, types,
+                 tech_stages, github: Optional['GitHubContext'], jenkins: Optional['JenkinsContext'], main_info):
+    """
+      Update a dataset's info from its Airtable sources, and plan the GitHub, Airtable, Jenkins and file changes
+      that go with it.
+    """
+    dataset_info = tree.info(dataset_dir)
+    source_ids = [source_id for source_id, source in sources]
+    for i, (source_id, source) in enumerate(sources):
+        update_info(dataset_info, source, producers, families, types, source_ids[:i + 1], i > 0, dataset_dir)
+        if github is not None:
+            with span('plan GitHub', 'github'):
+                issue_number, issue_url = backends.load('github').plan_github(
+                    plan, dataset_dir, dataset_info.get('transform', {}).get('main_issue', None), dataset_dir,
+                    source, github, source_id, tech_stages)
+                if issue_number is not None:
+                    if 'transform' not in dataset_info:
+                        dataset_info['transform'] = {}
+                    dataset_info['transform']['main_issue'] = issue_number
+                    if source.get('GitHub Issue Number', None) != issue_number or \
+                            source.get('GitHub Issue URL', None) != issue_url:
+                        print(f'Airtable GitHub link needs update')
+                        plan.update_record(dataset_dir, source_id, {
+                            'GitHub Issue Number': issue_number,
+                            'GitHub Issue URL': issue_url
+                        })
+    if tree.info_changed(dataset_dir):
+        plan.write_file(dataset_dir, str(tree.root / dataset_dir / 'info.json'))
+    if jenkins is not None:
+        with span('plan Jenkins', 'jenkins'):
+            backends.load('jenkins').plan_jenkins(plan, jenkins, dataset_dir, main_info.get('github', None),
+                                                  main_info['family'])
+
+
+class SyncError(Exception):
+    pass
+
+
+class FamilyRepo:
+    """
+      A local family repository: its main info.json, naming the family, and its datasets, along with its GitHub
+      and Jenkins contexts once connected.
+    """
 
+    def __init__(self, root: Path, validators: ValidatorRegistry, family_name: Optional[str] = None):
+        self.root = root
+        self.datasets_path = root / 'datasets'
+        self.datasets_path.mkdir(exist_ok=True)
+        self.main_info_file = self.datasets_path / 'info.json'
+        if self.main_info_file.exists():
+            with open(self.main_info_file) as info_file:
+                self.main_info = json.load(info_file, object_pairs_hook=OrderedDict)
+                validators.validate(self.main_info, self.main_info.get('$schema', PIPELINES_SCHEMA))
+        else:
+            self.main_info = OrderedDict()
+        if family_name is not None:
+            self.family_name = family_name
+        elif 'family' in self.main_info:
+            self.family_name = self.main_info['family']
+        else:
+            raise SyncError(f'No family argument given and no family found in {self.main_info_file}')
+        with span('read datasets'):
+            self.tree = DatasetTree(self.datasets_path, validators)
+        self.github: Optional['GitHubContext'] = None
+        self.jenkins: Optional['JenkinsContext'] = None
+        self.github_connected = False
+        self.board_loaded = False
+        self.jenkins_connected = False
+
+    def connect(self, services: 'SyncServices'):
+        """
+          Look up the family's GitHub repository, project board and Jenkins jobs, unless already done.
+        """
+        main_info = self.main_info
+        if not self.github_connected:
+            self.github = None
+            if 'github' in main_info:
+                self.github = backends.load('github').get_github_context(services.github, main_info['github'])
+            self.github_connected = True
+            self.board_loaded = False
+        if not self.board_loaded:
+            with span('GitHub project board'):
+                if self.github is not None and services.github_token is not None:
+                    github_backend = backends.load('github')
+                    trans_board = github_backend.get_project_board(self.github, main_info.get('project', None))
+                    if trans_board is not None:
+                        print(trans_board.html_url)
+                        self.github.issue_column, self.github.todo_column = github_backend.get_board_issue_columns(
+                            services.graphql, trans_board, main_info['github'], GITHUB_GRAPHQL_URL)
+            self.board_loaded = True
+        if not self.jenkins_connected:
+            self.jenkins = None
+            if 'jenkins' in main_info and 'base' in main_info['jenkins'] and 'path' in main_info['jenkins']:
+                with span('Jenkins jobs'):
+                    self.jenkins = backends.load('jenkins').JenkinsContext(
+                        services.jenkins(main_info['jenkins']['base']), main_info['jenkins']['path'],
+                        services.jenkins_configs, backends.load('git').branch_ref(self.root))
+            self.jenkins_connected = True
+
+
+class SyncServices:
+    """
+      The tokens, service clients, Jenkins config cache and Airtable tables shared by all the families synced in
+      a run, so that each is only set up, or downloaded, once.
+    """
 
-@lru_cache()
-def fetch_json(url):
-    return requests.get(url).json()
+    def __init__(self, airtable_token, github_token, jenkins_creds, verify_all: bool = False,
+                 github_cache: Optional[HTTPCache] = None):
+        self.airtable_token = airtable_token
+        self.github_token = github_token
+        self.github_cache = github_cache
+        self.jenkins_creds = jenkins_creds
+        self.verify_all = verify_all
+        self._jenkins_configs: Optional['JenkinsConfigCache'] = None
+        self._github: Optional['Github'] = None
+        self._graphql: Optional[requests.Session] = None
+        self._jenkins: Dict[str, 'Jenkins'] = {}
+        self.sources: Dict[str, dict] = {}
+        self.families: Dict[str, dict] = {}
+        self.producers: Dict[str, dict] = {}
+        self.types: Dict[str, dict] = {}
+
+    def fetch_airtable(self, family_names: List[str], record_ids: List[str], full_refresh: bool = False,
+                       lookups: bool = True):
+        """
+          Fetch the families' sources, and unless told otherwise, the Family, Dataset Producer and Type tables.
+        """
+        with span('fetch Airtable'), ThreadPoolExecutor(max_workers=AIRTABLE_WORKERS) as pool:
+            fetching_sources = pool.submit(fetch_sources, self.airtable_token, family_names, record_ids,
+                                           full_refresh)
+            if lookups:
+                fetching_families = pool.submit(fetch_table, self.airtable_token, 'Family', full_refresh)
+                fetching_producers = pool.submit(fetch_table, self.airtable_token, 'Dataset Producer',
+                                                 full_refresh)
+                fetching_types = pool.submit(fetch_table, self.airtable_token, 'Type', full_refresh)
+                self.families = fetching_families.result()
+                self.producers = fetching_producers.result()
+                self.types = fetching_types.result()
+            self.sources = fetching_sources.result()
+
+    def fetch_families(self, family_repos: List[FamilyRepo], full_refresh: bool = False, lookups: bool = True):
+        """
+          Fetch the sources of all the families at once, along with any others their datasets refer to.
+        """
+        family_names = list(OrderedDict.fromkeys(family.family_name for family in family_repos))
+        record_ids = list(OrderedDict.fromkeys(record_id for family in family_repos
+                                               for record_id in family.tree.record_dirs))
+        self.fetch_airtable(family_names, record_ids, full_refresh, lookups)
+
+    @property
+    def github(self) -> 'Github':
+        if self._github is None:
+            self._github = backends.load('github').connect(self.github_token, GITHUB_API_URL, GITHUB_POOL_SIZE,
+                                                           GITHUB_SERVICE, self.github_cache)
+        return self._github
+
+    @property
+    def graphql(self) -> requests.Session:
+        if self._graphql is None:
+            self._graphql = requests.Session()
+            self._graphql.headers['Authorization'] = f'bearer {self.github_token}'
+            self._graphql.mount(GITHUB_GRAPHQL_URL, GITHUB_GRAPHQL_SERVICE.adapter())
+        return self._graphql
+
+    @property
+    def jenkins_configs(self) -> 'JenkinsConfigCache':
+        if self._jenkins_configs is None:
+            self._jenkins_configs = backends.load('jenkins').JenkinsConfigCache(JENKINS_CONFIG_CACHE, self.verify_all)
+        return self._jenkins_configs
+
+    def jenkins(self, base: str) -> 'Jenkins':
+        if base not in self._jenkins:
+            self._jenkins[base] = backends.load('jenkins').connect(base, self.jenkins_creds['username'],
+                                                                   self.jenkins_creds['token'], JENKINS_SERVICE)
+            TRACER.service(base, 'jenkins')
+        return self._jenkins[base]
+
+    def airtable_updates(self) -> AirtableUpdates:
+        return AirtableUpdates(PacedAirtable(AIRTABLE_BASE, 'Source Data', api_key=self.airtable_token))
+
+    def save(self):
+        if self._jenkins_configs is not None:
+            self.jenkins_configs.save()
+
+
+def sync_family(family_repo: FamilyRepo, services: SyncServices, args, records: Optional[Set[str]] = None,
+                datasets: Optional[Set[str]] = None) -> SyncPlan:
+    """
+      Sync one family repository with the Airtable data already fetched, returning the plan of changes, which
+      are made unless only planning. Given the IDs of changed Airtable records and/or the names of changed
+      datasets, only the datasets concerned are synced.
+    """
+    main_info = family_repo.main_info
+    tree = family_repo.tree
+    source_dataset_path = tree.record_dirs
+    sources, families, producers, types = services.sources, services.families, services.producers, services.types
+    # Only the families' sources are fetched, so also count the stages previously recorded locally as
+    # Airtable-managed labels, in order that they get removed from issues that have moved on.
+    tech_stages = tree.stages() | set([stage for source in sources.values() for stage in source.get('Tech Stage', [])])
+
+    family_id = next((id for (id, family) in families.items() if family['Name'] == family_repo.family_name), None)
+    if family_id is None:
+        family_names = [family['Name'] for family in families.values()]
+        family_list = " - " + ",\n - ".join(family_names)
+        raise SyncError(f"Family '{family_repo.family_name}' doesn't exist, choose from:\n{family_list}")
 
+    main_info['family'] = families[family_id]["Name"]
 
-def validate(json_obj, schema_url):
-    schema_obj = fetch_json(schema_url)
-    jsonschema.validate(instance=json_obj, schema=schema_obj)
+    family_repo.connect(services)
+    github = family_repo.github
+    jenkins = family_repo.jenkins
+
+    # Group the family's sources by dataset directory, as several sources can share one
+    dataset_sources: Dict[str, List[str]] = OrderedDict()
+    for source_id, source in sources.items():
+        if ('Family' in source and family_id in source['Family']) or (source_id in source_dataset_path):
+            if 'BA Stage' in source and source['BA Stage'] == 'Not Required':
+                print(f'{source} marked as not required, so ignoring.')
+                continue
+            if 'Producer' in source and len(source['Producer']) == 1:
+                producer = pathify(producers[source['Producer'][0]]['Name'])
+                if source_id in source_dataset_path:
+                    dataset_dir = source_dataset_path[source_id]
+                elif 'Name' in source:
+                    dataset_dir = f"{producer}-{pathify(source['Name'])}"
+                else:
+                    print(f'No existing dataset directory for source, and source has no name, so ignoring:\n{source}')
+                    continue
+                if dataset_dir in tree.read_errors:
+                    print(f"Error loading {family_repo.datasets_path / dataset_dir / 'info.json'} as JSON:\n"
+                          f"{tree.read_errors[dataset_dir]}")
+                    continue
+                dataset_sources.setdefault(dataset_dir, []).append(source_id)
+
+    # Work out every change before making any of them. Datasets are planned concurrently, each into a plan of its
+    # own, which are then merged, along with what was printed for each, in dataset order.
+    def _plan_dataset(dataset_dir: str) -> SyncPlan:
+        dataset_plan = SyncPlan()
+        with span(dataset_dir, 'dataset'):
+            plan_dataset(dataset_plan, tree, dataset_dir,
+                         [(source_id, sources[source_id]) for source_id in dataset_sources[dataset_dir]],
+                         producers, families, types, tech_stages, github, jenkins, main_info)
+        return dataset_plan
+
+    to_plan = [dataset_dir for dataset_dir, source_ids in dataset_sources.items()
+               if (records is None and datasets is None) or
+               (records is not None and any(source_id in records for source_id in source_ids)) or
+               (datasets is not None and dataset_dir in datasets)]
+    plan = SyncPlan()
+    for dataset_plan in map_ordered(_plan_dataset, to_plan, args.workers):
+        plan.extend(dataset_plan)
+
+    main_info['pipelines'] = sorted(dataset_sources)
+    main_info_text = json.dumps(main_info, indent=4)
+    if not family_repo.main_info_file.exists() or family_repo.main_info_file.read_text() != main_info_text:
+        plan.write_file(None, str(family_repo.main_info_file))
+
+    if args.plan is not None:
+        return plan
+
+    if github is not None and args.github:
+        with span('apply GitHub', 'github'):
+            backends.load('github').apply_github(plan, github, tree)
+    elif len(plan.issues) + len(plan.labels) + len(plan.cards) > 0:
+        print('Re-run with -g to make the GitHub changes.')
+    if args.airtable:
+        airtable_updates = services.airtable_updates()
+        for update in plan.airtable:
+            airtable_updates.queue(update['record'], update['fields'])
+        with span('apply Airtable', 'airtable'):
+            airtable_updates.flush()
+    elif len(plan.airtable) > 0:
+        print('Re-run with -a to update the Airtable GitHub links.')
+    if jenkins is not None:
+        if args.jenkins:
+            with span('apply Jenkins', 'jenkins'):
+                backends.load('jenkins').apply_jenkins(plan, jenkins, interactive=not args.daemon,
+                                                       workers=args.workers)
+        elif len(plan.jenkins) > 0:
+            print('Re-run with -j to make the Jenkins changes.')
+
+    with span('write files'):
+        changed_info = 0
+        for f in plan.files:
+            if f['dataset'] is not None:
+                changed_info += tree.write_info(f['dataset'])
+            else:
+                changed_info += write_if_changed(family_repo.main_info_file, main_info_text)
+    print(f'{changed_info} of {len(dataset_sources) + 1} info.json files changed.')
+
+    if records is None and datasets is None:
+        with span('web pages'):
+            update_web_pages(tree)
+    return plan
+
+
+def read_manifest(manifest: Path) -> List[Path]:
+    """
+      Family repository directories listed one per line in a manifest file, relative to the manifest. Blank
+      lines and lines starting with # are ignored.
+    """
+    with open(manifest) as manifest_file:
+        return [manifest.parent / line.strip() for line in manifest_file
+                if line.strip() != '' and not line.strip().startswith('#')]
 
 
 def sync():
@@ -307,7 +533,55 @@ def sync():
     parser.add_argument('--github', '-g', help='Update/create related GitHub issues', action='store_true')
     parser.add_argument('--jenkins', '-j', help='Update/create related Jenkins jobs', action='store_true')
     parser.add_argument('--airtable', '-a', help='Update Airtable with GitHub issue number & URL', action='store_true')
+    parser.add_argument('--verify-all', help='Fetch and compare all Jenkins job configurations, even those that '
+                                             'matched when last checked', action='store_true')
+    parser.add_argument('--offline', help='Only use bundled or previously cached JSON schemas',
+                        action='store_true')
+    parser.add_argument('--full-refresh', help='Download all Airtable records rather than just those changed since '
+                                               'the last sync', action='store_true')
+    parser.add_argument('--plan', nargs='?', const='-', metavar='FILE',
+                        help='Only work out the changes needed and write them as JSON to FILE, or standard output, '
+                             'without making any of them')
+    parser.add_argument('--profile', nargs='?', const='reposync-profile.json', metavar='FILE',
+                        help='Time each phase and remote call, writing a Chrome trace / flame graph compatible JSON '
+                             'report to FILE, by default reposync-profile.json')
+    parser.add_argument('--repos', nargs='+', type=Path, metavar='DIR',
+                        help='Sync each of these family repositories, rather than the current directory, sharing '
+                             'one Airtable download')
+    parser.add_argument('--manifest', type=Path, metavar='FILE',
+                        help='Sync the family repositories listed, one per line, in FILE')
+    parser.add_argument('--github-cache', type=Path, default=GITHUB_CACHE_DIR, metavar='DIR',
+                        help=f'Directory to cache GitHub responses in, revalidating them on later runs, by default '
+                             f'{GITHUB_CACHE_DIR}')
+    parser.add_argument('--github-cache-mb', type=float, default=GITHUB_CACHE_MB, metavar='MB',
+                        help=f'Size the GitHub response cache is kept within, by default {GITHUB_CACHE_MB}MB, 0 to '
+                             f'not cache')
+    parser.add_argument('--workers', type=int, default=DATASET_WORKERS, metavar='N',
+                        help=f'Datasets to work on at once, by default {DATASET_WORKERS}, 1 to work through them in '
+                             f'turn')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running after the first sync, resyncing the datasets affected by changes notified '
+                             'to a local HTTP endpoint, and everything every --poll seconds')
+    parser.add_argument('--listen', default=DAEMON_LISTEN, metavar='HOST:PORT',
+                        help=f'Address for the daemon to listen for change notifications on, by default '
+                             f'{DAEMON_LISTEN}')
+    parser.add_argument('--poll', type=float, default=DAEMON_POLL, metavar='SECONDS',
+                        help=f'Seconds between full resyncs by the daemon, by default {DAEMON_POLL:g}, 0 for never')
     args = parser.parse_args()
+    if args.daemon and args.plan is not None:
+        parser.error('--plan cannot be used with --daemon')
+    plan_output = sys.stdout
+    if args.plan == '-':
+        # Keep standard output for the plan alone, so that it can be redirected to a file or piped, and send the
+        # messages along the way, including the profile summary printed on exit, to standard error
+        sys.stdout = sys.stderr
+
+    if args.profile is not None:
+        TRACER.enable()
+        atexit.register(TRACER.report, args.profile)
+    TRACER.service(PacedAirtable.API_URL, 'airtable')
+    TRACER.service(GITHUB_API_URL, 'github')
+    TRACER.service(GITHUB_GRAPHQL_URL, 'github')
 
     if 'AIRTABLE_API_KEY' in os.environ:
         airtable_token = os.environ['AIRTABLE_API_KEY']
@@ -330,151 +604,69 @@ or put the token in the file {AIRTABLE_TOKEN_FILE}""")
     else:
         jenkins_creds = None
 
-    repo = Repo('.')
-
-    sources = {record['id']: record['fields'] for record in
-               Airtable(AIRTABLE_BASE, 'Source Data', api_key=airtable_token).get_all()}
-    families = {record['id']: record['fields'] for record in Airtable(AIRTABLE_BASE, 'Family', api_key=airtable_token).get_all()}
-    producers = {record['id']: record['fields'] for record in
-                 Airtable(AIRTABLE_BASE, 'Dataset Producer', api_key=airtable_token).get_all()}
-    types = {record['id']: record['fields'] for record in Airtable(AIRTABLE_BASE, 'Type', api_key=airtable_token).get_all()}
-    tech_stages = set([stage for source in sources.values() for stage in source.get('Tech Stage', [])])
-    ba_stages = set([source['BA Stage'] for source in sources.values() if 'BA Stage' in source])
-
-    datasets_path = Path('datasets')
-    datasets_path.mkdir(exist_ok=True)
-
-    main_info_file = datasets_path / 'info.json'
-    if main_info_file.exists():
-        with open(main_info_file) as info_file:
-            main_info = json.load(info_file, object_pairs_hook=OrderedDict)
-            validate(main_info,
-                     main_info.get('$schema', 'http://gss-cogs.github.io/family-schemas/pipelines-schema.json'))
-    else:
-        main_info = OrderedDict()
-
-    if args.family is not None:
-        family_name = args.family
-    elif 'family' in main_info:
-        family_name = main_info['family']
-    else:
-        parser.error('No family argument given and no family found in info.json')
-
-    family_id = next((id for (id, family) in families.items() if family['Name'] == family_name), None)
-    if family_id is None:
-        parser.error(f'Family "{family_name}" not found.')
-
-    main_info['family'] = families[family_id]["Name"]
-
-    if family_id is None:
-        family_names = [family['Name'] for family in families.values()]
-        family_list = " - " + ",\n - ".join(family_names)
-        parser.error(f"Family '{args.family}' doesn't exist, choose from:\n{family_list}")
-
-    issue_column: Dict[int, ProjectColumn] = {}
-    todo_column: Optional[ProjectColumn] = None
-    if 'github' in main_info and github_token is not None:
-        trans_board = get_project_board(github_token, main_info['github'], main_info.get('project', None))
-        if trans_board is not None:
-            print(trans_board.html_url)
-            for column in Bar('Fetching board issues').iter(list(trans_board.get_columns())):
-                if column.name.lower() == 'to do':
-                    todo_column = column
-                card_contents = [card.get_content() for card in column.get_cards()]
-                for issue in card_contents:
-                    if isinstance(issue, Issue) and main_info['github'].endswith(issue.repository.full_name):
-                        issue_column[issue.number] = column
-
-    source_dataset_path = {}
-    for existing_pipeline in datasets_path.iterdir():
-        if existing_pipeline.is_dir():
-            dataset_info_path = existing_pipeline / 'info.json'
-            if dataset_info_path.exists():
-                with open(dataset_info_path) as info_file:
-                    try:
-                        dataset_info = json.load(info_file, object_pairs_hook=OrderedDict)
-                        validate(dataset_info, dataset_info.get(
-                            '$schema', 'http://gss-cogs.github.io/family-schemas/dataset-schema.json'))
-                    except JSONDecodeError as e:
-                        print(f'Warning: problem reading {dataset_info_path}:\n{e}')
-                        continue
-                    except ValidationError as ve:
-                        print(f'Error validating {dataset_info_path}:')
-                        print(f'  {" / ".join(ve.absolute_path)}: {textwrap.shorten(ve.message, width=120)}')
-                if 'transform' in dataset_info and 'airtable' in dataset_info['transform']:
-                    recordIds = dataset_info['transform']['airtable']
-                    if type(recordIds) != list:
-                        recordIds = [recordIds]
-                    for recordId in recordIds:
-                        if recordId not in source_dataset_path:
-                            source_dataset_path[recordId] = existing_pipeline.name
-                        else:
-                            print(
-                                f'Warning: duplicate record ID {recordId} in {existing_pipeline.name} and {source_dataset_path[recordId]}')
-
-    pipelines = []
-    dataset_path_source = defaultdict(list)
-    touched_info = set()
-    for source_id, source in sources.items():
-        if ('Family' in source and family_id in source['Family']) or (source_id in source_dataset_path):
-            if 'BA Stage' in source and source['BA Stage'] == 'Not Required':
-                print(f'{source} marked as not required, so ignoring.')
-                continue
-            if 'Producer' in source and len(source['Producer']) == 1:
-                producer = pathify(producers[source['Producer'][0]]['Name'])
-                if source_id in source_dataset_path:
-                    dataset_dir = source_dataset_path[source_id]
-                elif 'Name' in source:
-                    dataset_dir = f"{producer}-{pathify(source['Name'])}"
-                else:
-                    print(f'No existing dataset directory for source, and source has no name, so ignoring:\n{source}')
-                    continue
-                if not (datasets_path / dataset_dir).exists():
-                    (datasets_path / dataset_dir).mkdir(parents=True)
-                dataset_info_path = datasets_path / dataset_dir / 'info.json'
-                if dataset_info_path.exists():
-                    with open(dataset_info_path) as info_file:
-                        try:
-                            dataset_info = json.load(info_file, object_pairs_hook=OrderedDict)
-                        except JSONDecodeError as e:
-                            print(f"Error loading {dataset_info_path} as JSON:\n{e}")
-                            continue
-                else:
-                    dataset_info = OrderedDict()
-                dataset_path_source[dataset_dir].append(source_id)
-                update_info(dataset_info, source, producers, families, types,
-                            dataset_path_source[dataset_dir], dataset_info_path in touched_info, dataset_dir)
-                if 'github' in main_info:
-                    issue_number, issue_url = update_github(dataset_info.get('transform', {}).get('main_issue', None),
-                                                            dataset_dir, source, github_token, main_info['github'],
-                                                            args.github,
-                                                            source_id, tech_stages, issue_column, todo_column)
-                    if issue_number is not None:
-                        if 'transform' not in dataset_info:
-                            dataset_info['transform'] = {}
-                        dataset_info['transform']['main_issue'] = issue_number
-                        if source.get('GitHub Issue Number', None) != issue_number or \
-                                source.get('GitHub Issue URL', None) != issue_url:
-                            print(f'Airtable GitHub link needs update')
-                            if args.airtable:
-                                update_airtable_issue(airtable_token, issue_number, issue_url, source_id)
-
-                pipelines.append(dataset_dir)
-                with open(dataset_info_path, 'w') as info_file:
-                    json.dump(dataset_info, info_file, indent=4)
-                    touched_info.add(dataset_info_path)
-
-                if 'jenkins' in main_info and 'base' in main_info['jenkins'] \
-                        and 'path' in main_info['jenkins']:
-                    update_jenkins(main_info['jenkins']['base'], main_info['jenkins']['path'], jenkins_creds,
-                                   dataset_dir, args.jenkins, main_info.get('github', None), repo.head.ref.path,
-                                   main_info['family'])
-
-    main_info['pipelines'] = sorted(set(pipelines))
-    with open(main_info_file, 'w') as info_file:
-        json.dump(main_info, info_file, indent=4)
-
-    update_web_pages(datasets_path)
+    validators = ValidatorRegistry(SchemaResolver(SCHEMA_CACHE_DIR,
+                                                  offline=args.offline or 'REPOSYNC_OFFLINE' in os.environ))
+    github_cache = None
+    if args.github_cache_mb > 0:
+        github_cache = HTTPCache(args.github_cache, int(args.github_cache_mb * 1024 * 1024))
+    services = SyncServices(airtable_token, github_token, jenkins_creds, args.verify_all, github_cache)
+
+    repo_dirs = list(args.repos or [])
+    if args.manifest is not None:
+        repo_dirs.extend(read_manifest(args.manifest))
+    batch = len(repo_dirs) > 0
+    if batch and args.family is not None:
+        parser.error('--family can only be used when syncing a single repository')
+
+    def _load_family_repos(strict: bool) -> List[FamilyRepo]:
+        family_repos = []
+        for repo_dir in (repo_dirs if batch else [Path('.')]):
+            try:
+                family_repos.append(FamilyRepo(repo_dir, validators, args.family))
+            except (SyncError, OSError) as e:
+                if strict:
+                    parser.error(str(e))
+                print(f'Skipping {repo_dir}: {e}')
+        return family_repos
+
+    family_repos = _load_family_repos(not batch)
+    services.fetch_families(family_repos, args.full_refresh)
+
+    plans = OrderedDict()
+    for family in family_repos:
+        if batch:
+            print(f'Syncing {family.family_name} in {family.root}')
+        try:
+            with span(family.family_name, 'family'):
+                plans[str(family.root)] = sync_family(family, services, args)
+        except SyncError as e:
+            if not batch:
+                parser.error(str(e))
+            print(f'Skipping {family.root}: {e}')
+    services.save()
+
+    if args.daemon:
+        host, _, port = args.listen.rpartition(':')
+        daemon = SyncDaemon(family_repos, services, args, lambda: _load_family_repos(False), sync_family,
+                            (host or DAEMON_LISTEN.split(':')[0], int(port)), args.poll)
+        try:
+            daemon.serve()
+        except KeyboardInterrupt:
+            print('Stopping.')
+        finally:
+            daemon.stop()
+            services.save()
+
+    if args.plan is not None:
+        if batch:
+            plan_json = json.dumps({root: plan.to_dict() for root, plan in plans.items()}, indent=4)
+        else:
+            plan_json = next(iter(plans.values())).to_json()
+        if args.plan == '-':
+            print(plan_json, file=plan_output)
+        else:
+            with open(args.plan, 'w') as plan_file:
+                plan_file.write(plan_json)
 
 
 if __name__ == "__main__":
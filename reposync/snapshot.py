@@ -0,0 +1,107 @@
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, Optional
+
+from airtable import Airtable
+
+# Allow for clock skew between us and Airtable when asking for records modified since the watermark.
+SNAPSHOT_SKEW = timedelta(minutes=5)
+# Airtable formulas are limited in length, so look up records by ID a chunk at a time.
+RECORD_ID_CHUNK = 50
+# Airtable returns at most 100 records per request
+AIRTABLE_PAGE_SIZE = 100
+
+
+class AirtableSnapshot:
+    """
+      Local copy of the records returned by a query against an Airtable table, along with the time it was
+      last brought up to date.
+    """
+
+    def __init__(self, store_dir: Path, base_id: str, table_name: str, **options):
+        self.table_name = table_name
+        query = json.dumps({'base': base_id, 'table': table_name, 'options': options}, sort_keys=True)
+        self.path = store_dir / f'{base_id}-{sha256(query.encode("utf-8")).hexdigest()[:16]}.json'
+        self.records: Dict[str, dict] = OrderedDict()
+        self.watermark: Optional[datetime] = None
+
+    def load(self):
+        if self.path.exists():
+            try:
+                with open(self.path) as snapshot_file:
+                    stored = json.load(snapshot_file, object_pairs_hook=OrderedDict)
+                self.records = stored['records']
+                self.watermark = datetime.fromisoformat(stored['watermark'])
+            except (ValueError, KeyError) as e:
+                print(f'Warning: ignoring unreadable Airtable snapshot {self.path}:\n{e}')
+                self.records = OrderedDict()
+                self.watermark = None
+        return self
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as snapshot_file:
+            json.dump({'table': self.table_name,
+                       'watermark': self.watermark.isoformat(),
+                       'records': self.records}, snapshot_file)
+        os.replace(tmp_path, self.path)
+
+
+def _and(*formulas):
+    formulas = [formula for formula in formulas if formula]
+    return formulas[0] if len(formulas) == 1 else f"AND({', '.join(formulas)})"
+
+
+def fetch_records_by_id(airtable: Airtable, record_ids, formula=None, **options):
+    records = OrderedDict()
+    record_ids = list(record_ids)
+    for i in range(0, len(record_ids), RECORD_ID_CHUNK):
+        by_id = "OR(" + ', '.join(f"RECORD_ID()='{rec_id}'" for rec_id in record_ids[i:i + RECORD_ID_CHUNK]) + ")"
+        records.update((record['id'], record['fields'])
+                       for record in airtable.get_all(formula=_and(formula, by_id), **options))
+    return records
+
+
+def fetch_records(airtable: Airtable, snapshot: Optional[AirtableSnapshot] = None, id_field: str = 'Name',
+                  full_refresh: bool = False, **options) -> Dict[str, dict]:
+    """
+      Fetch records from an Airtable table as {record id: fields}.
+
+      With a snapshot, only records modified since the snapshot's watermark are downloaded in full. The
+      current set of record IDs is listed using just the (small) id_field, so that deleted records are dropped
+      and the order matches what a full fetch would give. Listing the IDs takes as many requests as fetching
+      everything, so this saves bytes, not requests, at the cost of the query for modified records; tables
+      that fit in one page are simply fetched in full.
+    """
+    formula = options.pop('formula', None)
+    query = dict(options, formula=formula) if formula else options
+    if snapshot is None:
+        return OrderedDict((record['id'], record['fields']) for record in airtable.get_all(**query))
+
+    started = datetime.now(timezone.utc)
+    if full_refresh or snapshot.watermark is None or len(snapshot.records) < AIRTABLE_PAGE_SIZE:
+        records = OrderedDict((record['id'], record['fields']) for record in airtable.get_all(**query))
+    else:
+        since = (snapshot.watermark - SNAPSHOT_SKEW).astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        modified = f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{since}'))"
+        changed = OrderedDict((record['id'], record['fields']) for record in
+                              airtable.get_all(formula=_and(formula, modified), **options))
+        id_query = dict(query, fields=[id_field])
+        live_ids = [record['id'] for record in airtable.get_all(**id_query)]
+        missing = [rec_id for rec_id in live_ids if rec_id not in changed and rec_id not in snapshot.records]
+        if len(missing) > 0:
+            changed.update(fetch_records_by_id(airtable, missing, formula, **options))
+        records = OrderedDict((rec_id, changed[rec_id] if rec_id in changed else snapshot.records[rec_id])
+                              for rec_id in live_ids if rec_id in changed or rec_id in snapshot.records)
+        removed = len(set(snapshot.records) - set(live_ids))
+        print(f'{snapshot.table_name}: {len(changed)} changed, {removed} removed since '
+              f'{snapshot.watermark:%Y-%m-%d %H:%M}')
+    snapshot.records = records
+    snapshot.watermark = started
+    snapshot.save()
+    return records
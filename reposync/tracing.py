@@ -0,0 +1,179 @@
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List
+from urllib.parse import urlparse
+
+import requests
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+      A timed, named section of a run, nested within whichever span was open on the same thread when it started.
+    """
+
+    def __init__(self, tracer: 'Tracer', name: str, category: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer._record(self, duration)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class Tracer:
+    """
+      Records nested spans around the phases of a sync and every HTTP request made through requests, with the
+      service, endpoint, status and size of each response. Does nothing until enabled, when the report can be
+      written as a Chrome trace, which can be viewed as a flame graph with chrome://tracing, Perfetto or
+      speedscope.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events: List[dict] = []
+        self.services: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._threads: Dict[int, int] = {}
+        self._origin = time.perf_counter()
+        self._send = None
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self._origin = time.perf_counter()
+        send = requests.Session.send
+        tracer = self
+
+        def traced_send(session, request, **kwargs):
+            with tracer.request_span(request) as span:
+                response = send(session, request, **kwargs)
+                if kwargs.get('stream', False):
+                    size = int(response.headers.get('Content-Length', 0))
+                else:
+                    size = len(response.content)
+                span.set(status=response.status_code, bytes=size)
+                if 'X-Reposync-Cache' in response.headers:
+                    span.set(cache=response.headers['X-Reposync-Cache'])
+            return response
+
+        self._send = send
+        requests.Session.send = traced_send
+
+    def disable(self):
+        if self._send is not None:
+            requests.Session.send = self._send
+            self._send = None
+        self.enabled = False
+
+    def service(self, url: str, name: str):
+        """
+          Name the service for requests to the host of the given URL.
+        """
+        host = urlparse(url).hostname if '//' in url else url
+        if host is not None:
+            self.services[host] = name
+
+    def span(self, name: str, category: str = 'phase', **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def request_span(self, request: requests.PreparedRequest):
+        url = urlparse(request.url)
+        service = self.services.get(url.hostname, url.hostname)
+        endpoint = f'{request.method} {url.path}'
+        return Span(self, f'{service} {endpoint}', 'request', {'service': service, 'endpoint': endpoint})
+
+    def _record(self, span: Span, duration: float):
+        ident = threading.get_ident()
+        with self._lock:
+            tid = self._threads.setdefault(ident, len(self._threads) + 1)
+            self.events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': round((span.start - self._origin) * 1e6),
+                'dur': round(duration * 1e6),
+                'pid': 1,
+                'tid': tid,
+                'args': span.args
+            })
+
+    def summary(self) -> Dict[str, dict]:
+        """
+          Request counts, time and bytes per service and endpoint, with numeric path segments (issue numbers and
+          the like) merged.
+        """
+        services = OrderedDict()
+        for event in sorted(self.events, key=lambda e: e['ts']):
+            if event['cat'] != 'request':
+                continue
+            service = services.setdefault(event['args']['service'],
+                                          {'requests': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0, 'cached': 0,
+                                           'endpoints': {}})
+            endpoint = service['endpoints'].setdefault(re.sub(r'/\d+(?=/|$)', '/:n', event['args']['endpoint']),
+                                                       {'requests': 0, 'seconds': 0.0, 'bytes': 0})
+            for totals in (service, endpoint):
+                totals['requests'] += 1
+                totals['seconds'] += event['dur'] / 1e6
+                totals['bytes'] += event['args'].get('bytes', 0)
+            if 'error' in event['args'] or event['args'].get('status', 200) >= 400:
+                service['errors'] += 1
+            if 'cache' in event['args']:
+                service['cached'] += 1
+        return services
+
+    def report(self, path: str):
+        summary = self.summary()
+        thread_names = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': f'thread {tid}'}}
+                        for tid in self._threads.values()]
+        with open(path, 'w') as report_file:
+            json.dump({'traceEvents': thread_names + self.events, 'displayTimeUnit': 'ms', 'summary': summary},
+                      report_file, indent=1)
+        for name, service in summary.items():
+            print(f'{name}: {service["requests"]} requests, {service["errors"]} failed, '
+                  f'{service["cached"]} not modified, {service["seconds"]:.1f}s, {service["bytes"] / 1024:.0f} KiB')
+        print(f'Profile written to {path}')
+
+
+TRACER = Tracer()
+
+
+def span(name: str, category: str = 'phase', **args):
+    """
+      A span of the run, timed if tracing is enabled, e.g.
+
+        with span('fetch Airtable'):
+            ...
+    """
+    return TRACER.span(name, category, **args)
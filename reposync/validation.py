@@ -0,0 +1,148 @@
+import json
+from hashlib import sha256
+from importlib import resources
+from json import JSONDecodeError
+from pathlib import Path
+from typing import Dict, Optional
+
+import requests
+from jsonschema import FormatChecker
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+try:
+    from referencing import Registry, Resource
+    from referencing.jsonschema import DRAFT7
+except ImportError:
+    # jsonschema < 4.18 resolves $refs with a RefResolver instead
+    from jsonschema import RefResolver
+    Registry = None
+
+try:
+    from . import schemas
+    from .ratelimit import Service
+    from .tracing import TRACER, span
+except:
+    import schemas
+    from ratelimit import Service
+    from tracing import TRACER, span
+
+# Schemas shipped in the reposync.schemas package, served without going to the network.
+BUNDLED_SCHEMAS = {
+    'http://gss-cogs.github.io/family-schemas/dataset-schema.json': 'dataset-schema.json',
+    'http://gss-cogs.github.io/family-schemas/pipelines-schema.json': 'pipelines-schema.json',
+}
+# Schemas are static files, so only worth a couple of quick tries before falling back to the cached copy
+SCHEMA_SERVICE = Service('Schemas', rate=None, retries=2, timeout=(5, 15))
+
+
+class SchemaResolver:
+    """
+      Finds JSON schemas by URL, first from those bundled with reposync, then from an on-disk cache which is
+      revalidated using the ETag / Last-Modified headers. In offline mode, only bundled and cached schemas are
+      used.
+    """
+
+    def __init__(self, cache_dir: Path, offline: bool = False, bundled: Dict[str, str] = BUNDLED_SCHEMAS):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.bundled = bundled
+        self.session = requests.Session()
+        self.session.mount('https://', SCHEMA_SERVICE.adapter())
+        self.session.mount('http://', SCHEMA_SERVICE.adapter())
+        for url in bundled:
+            TRACER.service(url, 'schemas')
+        self._schemas: Dict[str, Optional[dict]] = {}
+
+    def get(self, url: str) -> Optional[dict]:
+        if url not in self._schemas:
+            with span(f'schema {url}', 'schemas'):
+                self._schemas[url] = self._resolve(url)
+        return self._schemas[url]
+
+    def _resolve(self, url: str) -> Optional[dict]:
+        if url in self.bundled:
+            return json.loads(resources.read_text(schemas, self.bundled[url]))
+        cache_file = self.cache_dir / (sha256(url.encode('utf-8')).hexdigest() + '.json')
+        cached = None
+        if cache_file.exists():
+            try:
+                with open(cache_file) as f:
+                    cached = json.load(f)
+            except JSONDecodeError:
+                cached = None
+        if self.offline:
+            if cached is None:
+                print(f'Warning: schema {url} is not available offline.')
+                return None
+            return cached['schema']
+        headers = {}
+        if cached is not None:
+            if cached.get('etag') is not None:
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified') is not None:
+                headers['If-Modified-Since'] = cached['last_modified']
+        try:
+            response = self.session.get(url, headers=headers)
+            if response.status_code == 304 and cached is not None:
+                return cached['schema']
+            response.raise_for_status()
+            schema = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if cached is not None:
+                print(f'Warning: unable to revalidate schema {url}, using cached copy:\n{e}')
+                return cached['schema']
+            print(f'Warning: unable to fetch schema {url}:\n{e}')
+            return None
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump({'url': url,
+                       'etag': response.headers.get('ETag', None),
+                       'last_modified': response.headers.get('Last-Modified', None),
+                       'schema': schema}, f)
+        tmp_file.replace(cache_file)
+        return schema
+
+
+class ValidatorRegistry:
+    """
+      JSON schema validators, compiled once per schema URL and reused for every instance. $refs are resolved
+      through the SchemaResolver.
+    """
+
+    def __init__(self, schemas: SchemaResolver):
+        self.schemas = schemas
+        self.format_checker = FormatChecker()
+        self._validators = {}
+
+    def _retrieve(self, url: str):
+        schema = self.schemas.get(url)
+        if schema is None:
+            raise LookupError(f'Schema {url} not available')
+        return schema
+
+    def get(self, url: str):
+        if url not in self._validators:
+            schema = self.schemas.get(url)
+            if schema is None:
+                self._validators[url] = None
+            else:
+                cls = validator_for(schema)
+                cls.check_schema(schema)
+                if Registry is not None:
+                    registry = Registry(retrieve=lambda uri: Resource.from_contents(
+                        self._retrieve(uri), default_specification=DRAFT7))
+                    self._validators[url] = cls(schema, registry=registry, format_checker=self.format_checker)
+                else:
+                    resolver = RefResolver.from_schema(schema, handlers={'http': self._retrieve,
+                                                                         'https': self._retrieve})
+                    self._validators[url] = cls(schema, resolver=resolver, format_checker=self.format_checker)
+        return self._validators[url]
+
+    def validate(self, instance, url: str):
+        validator = self.get(url)
+        if validator is not None:
+            error = best_match(validator.iter_errors(instance))
+            if error is not None:
+                raise error